@@ -0,0 +1,454 @@
+"""
+Benchmark suite for the upload pipeline.
+
+Runs main.main() against an in-process paramiko SFTP server, optionally
+behind a proxy that injects latency and a bandwidth limit, over synthetic
+trees, and reports wall time, files/s, MB/s and SFTP requests per file.
+
+    python benchmark.py
+    python benchmark.py --latency 0.05 --bandwidth 100M --scenario tiny-files
+    python benchmark.py --env INPUT_CONCURRENCY=16 --env INPUT_CONFIRMUPLOAD=false
+"""
+import argparse
+import collections
+import contextlib
+import io
+import json
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from unittest.mock import patch
+
+import paramiko
+from paramiko.sftp import CMD_EXTENDED
+from paramiko import (
+    AUTH_FAILED, AUTH_SUCCESSFUL, OPEN_SUCCEEDED, SFTP_OK,
+    SFTPAttributes, SFTPHandle, SFTPServer, SFTPServerInterface,
+)
+
+import main
+from utils import parse_size
+
+BENCH_USER = 'bench'
+BENCH_PASSWORD = 'bench'
+REMOTE_DIR = 'deploy'
+
+# Server transports log connection resets when the client disconnects
+logging.getLogger('paramiko').addHandler(logging.NullHandler())
+
+
+class ServerStats:
+    """Thread-safe counters of the SFTP requests the server handled."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = collections.Counter()
+
+    def count(self, request_type):
+        with self.lock:
+            self.requests[request_type] += 1
+
+    def total(self):
+        with self.lock:
+            return sum(self.requests.values())
+
+    def reset(self):
+        with self.lock:
+            self.requests.clear()
+
+
+class _BenchServer(paramiko.ServerInterface):
+    def __init__(self, stats, root_dir):
+        self.stats = stats
+        self.root_dir = root_dir
+
+    def check_auth_password(self, username, password):
+        if username == BENCH_USER and password == BENCH_PASSWORD:
+            return AUTH_SUCCESSFUL
+        return AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        return OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        # Commands run in a local shell with the served root as working directory
+        self.stats.count('exec')
+        threading.Thread(target=self._exec, args=(channel, command.decode('utf-8')), daemon=True).start()
+        return True
+
+    def _exec(self, channel, command):
+        with subprocess.Popen(command, shell=True, cwd=self.root_dir, stdin=subprocess.PIPE,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE) as proc:
+            for data in iter(lambda: channel.recv(65536), b''):
+                proc.stdin.write(data)
+            proc.stdin.close()
+            stdout, stderr = proc.stdout.read(), proc.stderr.read()
+            status = proc.wait()
+        channel.sendall(stdout)
+        channel.sendall_stderr(stderr)
+        channel.send_exit_status(status)
+        channel.close()
+
+
+class _BenchHandle(SFTPHandle):
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        if attr.st_size is not None:
+            try:
+                self.writefile.truncate(attr.st_size)
+            except OSError as e:
+                return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+
+class _BenchSFTPInterface(SFTPServerInterface):
+    """Serves a local directory as the SFTP root."""
+    root = None
+
+    def __init__(self, server, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.stats = server.stats
+
+    def _local(self, path):
+        return os.path.join(self.root, self.canonicalize(path).lstrip('/'))
+
+    def canonicalize(self, path):
+        return os.path.normpath('/' + path).replace('//', '/')
+
+    def _call(self, func, *args):
+        try:
+            func(*args)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def list_folder(self, path):
+        try:
+            local_path = self._local(path)
+            entries = []
+            for name in os.listdir(local_path):
+                attr = SFTPAttributes.from_stat(os.lstat(os.path.join(local_path, name)))
+                attr.filename = name
+                entries.append(attr)
+            return entries
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(self._local(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.lstat(self._local(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(self._local(path), flags, 0o644)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = _BenchHandle(flags)
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path):
+        return self._call(os.remove, self._local(path))
+
+    def rename(self, oldpath, newpath):
+        return self._call(os.rename, self._local(oldpath), self._local(newpath))
+
+    def posix_rename(self, oldpath, newpath):
+        return self._call(os.replace, self._local(oldpath), self._local(newpath))
+
+    def mkdir(self, path, attr):
+        return self._call(os.mkdir, self._local(path))
+
+    def rmdir(self, path):
+        return self._call(os.rmdir, self._local(path))
+
+    def chattr(self, path, attr):
+        if attr.st_size is not None:
+            return self._call(os.truncate, self._local(path), attr.st_size)
+        return SFTP_OK
+
+    def symlink(self, target_path, path):
+        return self._call(os.symlink, target_path, self._local(path))
+
+    def hardlink(self, oldpath, newpath):
+        return self._call(os.link, self._local(oldpath), self._local(newpath))
+
+    def readlink(self, path):
+        try:
+            return os.readlink(self._local(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+
+class _CountingSFTPServer(SFTPServer):
+    """Counts requests and adds the hardlink@openssh.com extension."""
+    def _process(self, t, request_number, msg):
+        self.server.stats.count(t)
+        if t == CMD_EXTENDED:
+            position = msg.packet.tell()
+            if msg.get_text() == 'hardlink@openssh.com':
+                oldpath, newpath = msg.get_text(), msg.get_text()
+                self._send_status(request_number, self.server.hardlink(oldpath, newpath))
+                return
+            msg.packet.seek(position)
+        super()._process(t, request_number, msg)
+
+
+class LocalSFTPServer:
+    """
+    In-process SFTP server stand-in listening on 127.0.0.1, serving root_dir.
+    """
+    host_key = None
+
+    def __init__(self, root_dir):
+        if LocalSFTPServer.host_key is None:
+            LocalSFTPServer.host_key = paramiko.RSAKey.generate(2048)
+        self.root_dir = root_dir
+        self.stats = ServerStats()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(100)
+        self.port = self.sock.getsockname()[1]
+        self.transports = []
+        self.running = True
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        interface = type('BenchSFTPInterface', (_BenchSFTPInterface,), {'root': self.root_dir})
+        while self.running:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                break
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler('sftp', _CountingSFTPServer, interface)
+            transport.start_server(server=_BenchServer(self.stats, self.root_dir))
+            self.transports.append(transport)
+
+    def close(self):
+        self.running = False
+        self.sock.close()
+        for transport in self.transports:
+            transport.close()
+
+
+class LinkEmulator:
+    """
+    TCP proxy in front of a server that delays every chunk by half the
+    round-trip latency in each direction and caps each direction's bandwidth.
+    Chunks are delayed independently, so pipelined requests still overlap.
+    """
+    def __init__(self, target_port, latency=0.0, bandwidth=0):
+        self.target_port = target_port
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(100)
+        self.port = self.sock.getsockname()[1]
+        self.running = True
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while self.running:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                break
+            server = socket.create_connection(('127.0.0.1', self.target_port))
+            for src, dst in ((client, server), (server, client)):
+                chunks = collections.deque()
+                ready = threading.Condition()
+                threading.Thread(target=self._read, args=(src, chunks, ready), daemon=True).start()
+                threading.Thread(target=self._write, args=(dst, chunks, ready), daemon=True).start()
+
+    def _read(self, src, chunks, ready):
+        while True:
+            try:
+                data = src.recv(65536)
+            except OSError:
+                data = b''
+            with ready:
+                chunks.append((time.monotonic() + self.latency / 2, data))
+                ready.notify()
+            if not data:
+                return
+
+    def _write(self, dst, chunks, ready):
+        while True:
+            with ready:
+                while not chunks:
+                    ready.wait()
+                deliver_at, data = chunks.popleft()
+            delay = deliver_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            if not data:
+                with contextlib.suppress(OSError):
+                    dst.shutdown(socket.SHUT_WR)
+                return
+            try:
+                dst.sendall(data)
+            except OSError:
+                return
+            if self.bandwidth:
+                time.sleep(len(data) / self.bandwidth)
+
+    def close(self):
+        self.running = False
+        self.sock.close()
+
+
+def _write_file(path, size, seed):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        # Distinct, poorly compressible content per file
+        block = os.urandom(min(size, 65536)) if size else b''
+        written = 0
+        while written < size:
+            f.write(block[:size - written])
+            written += len(block)
+        f.write(str(seed).encode())
+
+
+def make_tree(local_dir, files, size, dirs):
+    """Create `files` files of roughly `size` bytes spread over `dirs` directories."""
+    for i in range(files):
+        _write_file(os.path.join(local_dir, f"dir{i % dirs}", f"file{i}.bin"), size, i)
+
+
+def touch_fraction(local_dir, fraction):
+    """Rewrite a fraction of the files in a tree, returning how many changed."""
+    paths = sorted(
+        os.path.join(root, name)
+        for root, _, names in os.walk(local_dir)
+        for name in names
+    )
+    step = max(1, int(round(1 / fraction))) if fraction else len(paths) + 1
+    changed = paths[::step]
+    for i, path in enumerate(changed):
+        _write_file(path, os.path.getsize(path), -i - 1)
+    return len(changed)
+
+
+SCENARIOS = {
+    # name: (files, size, dirs, fraction changed before the measured run or None)
+    'tiny-files': (2000, 1024, 50, None),
+    'huge-files': (3, 32 * 1024 * 1024, 1, None),
+    'incremental': (2000, 4096, 50, 0.01),
+}
+
+
+def run_scenario(name, scale, latency, bandwidth, env):
+    files, size, dirs, fraction = SCENARIOS[name]
+    files = max(1, int(files * scale))
+    work_dir = tempfile.mkdtemp(prefix='sftp-bench-')
+    local_dir = os.path.join(work_dir, 'local')
+    remote_root = os.path.join(work_dir, 'remote')
+    os.makedirs(os.path.join(remote_root, REMOTE_DIR))
+    make_tree(local_dir, files, size, dirs)
+
+    server = LocalSFTPServer(remote_root)
+    link = LinkEmulator(server.port, latency, bandwidth) if latency or bandwidth else None
+    try:
+        run_env = {
+            'INPUT_HOST': '127.0.0.1',
+            'INPUT_PORT': str(link.port if link else server.port),
+            'INPUT_USERNAME': BENCH_USER,
+            'INPUT_PASSWORD': BENCH_PASSWORD,
+            'INPUT_LOCALDIR': local_dir,
+            'INPUT_REMOTEDIR': REMOTE_DIR,
+        }
+        run_env.update(env)
+
+        def deploy():
+            with patch.dict(os.environ, run_env), contextlib.redirect_stdout(io.StringIO()) as output:
+                try:
+                    main.main()
+                except SystemExit as e:
+                    if e.code:
+                        raise RuntimeError(f"Deploy failed:\n{output.getvalue()}")
+
+        changed = files
+        if fraction is not None:
+            deploy()
+            changed = touch_fraction(local_dir, fraction)
+
+        server.stats.reset()
+        start = time.perf_counter()
+        deploy()
+        wall = time.perf_counter() - start
+
+        uploaded_bytes = changed * size
+        requests = server.stats.total()
+        return {
+            'scenario': name,
+            'files': files,
+            'changed': changed,
+            'wall_s': round(wall, 3),
+            'files_per_s': round(files / wall, 1),
+            'mb_per_s': round(uploaded_bytes / wall / 1e6, 2),
+            'requests_per_file': round(requests / max(1, changed), 2),
+        }
+    finally:
+        if link:
+            link.close()
+        server.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main_benchmark(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS), help='Scenario to run (repeatable, default: all)')
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiply the number of files in each scenario')
+    parser.add_argument('--latency', type=float, default=0.0, help='Injected round-trip latency in seconds')
+    parser.add_argument('--bandwidth', default='0', help='Bandwidth limit per direction in bytes/s (e.g. 100M), 0 for none')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE', help='Extra action input, e.g. INPUT_CONCURRENCY=8')
+    parser.add_argument('--json', metavar='PATH', help='Also write the results as JSON')
+    args = parser.parse_args(argv)
+
+    env = dict(item.split('=', 1) for item in args.env)
+    results = []
+    for name in args.scenario or sorted(SCENARIOS):
+        result = run_scenario(name, args.scale, args.latency, parse_size(args.bandwidth), env)
+        results.append(result)
+        print(f"{result['scenario']:<12} files={result['files']:<6} changed={result['changed']:<6} "
+              f"wall={result['wall_s']:>8.3f}s files/s={result['files_per_s']:>9.1f} "
+              f"MB/s={result['mb_per_s']:>8.2f} requests/file={result['requests_per_file']:>6.2f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main_benchmark()
@@ -0,0 +1,140 @@
+import threading
+import time
+
+from logger import log
+
+# Workers started with `concurrency: auto`, and the most it will grow to
+AUTO_INITIAL_WORKERS = 2
+AUTO_MAX_WORKERS = 32
+
+# Seconds between throughput measurements
+AUTO_INTERVAL = 3.0
+
+# A step must raise throughput by this factor to be kept, and throughput
+# falling below this fraction of the best seen makes the controller back off
+IMPROVEMENT = 1.1
+DEGRADATION = 0.75
+
+class ConcurrencyController:
+    """
+    Adjusts the number of upload workers while the run is in progress.
+
+    Every interval it measures files and bytes completed per second. While
+    there is a backlog, it adds about half as many workers again as are
+    running, and keeps them only if throughput improved. Otherwise they are
+    retired and the count is capped there. Throughput falling well below the
+    best seen retires a worker, and so does the server refusing a new channel
+    (MaxSessions), which also caps the count.
+
+    Workers are started through start_worker(worker_id) and retire themselves
+    between tasks when should_retire() says so.
+    """
+    def __init__(self, start_worker, metrics, task_queue, initial=AUTO_INITIAL_WORKERS, maximum=AUTO_MAX_WORKERS, interval=None):
+        self.start_worker = start_worker
+        self.metrics = metrics
+        self.task_queue = task_queue
+        self.initial = initial
+        self.ceiling = maximum
+        self.interval = interval or AUTO_INTERVAL
+        self.lock = threading.Lock()
+        self.active = set()
+        self.next_id = 1
+        self.to_retire = 0
+        self.last_added = 0
+        self.best_rate = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self._add(self.initial)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop adjusting; call before sending the workers their sentinels."""
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+
+    def _add(self, count):
+        for _ in range(count):
+            with self.lock:
+                worker_id = self.next_id
+                self.next_id += 1
+                self.active.add(worker_id)
+            self.start_worker(worker_id)
+
+    def _retire(self, count):
+        with self.lock:
+            self.to_retire += count
+
+    def should_retire(self, worker_id):
+        with self.lock:
+            if self.to_retire and len(self.active) > 1:
+                self.to_retire -= 1
+                self.active.discard(worker_id)
+                return True
+            return False
+
+    def channel_failed(self, worker_id, error):
+        """
+        Called by a worker that couldn't open its channel. Returns True if
+        that is handled by running with fewer workers, False if no worker
+        is left and it is a real error.
+        """
+        with self.lock:
+            self.active.discard(worker_id)
+            if not self.active:
+                return False
+            self.ceiling = len(self.active)
+            self.last_added = 0
+        log.warning(f"Warning: The server refused another channel ({error}), limiting concurrency to {self.ceiling}.")
+        return True
+
+    def _completed(self):
+        counters = self.metrics.counters
+        files = counters['files_uploaded'] + counters['files_moved'] + counters['files_linked'] + counters['files_reused']
+        return files, counters['bytes_uploaded']
+
+    def _run(self):
+        last_files, last_bytes = self._completed()
+        last_time = time.time()
+        while not self.stop_event.wait(self.interval):
+            files, uploaded = self._completed()
+            now = time.time()
+            rate = ((files - last_files) / (now - last_time), (uploaded - last_bytes) / (now - last_time))
+            last_files, last_bytes, last_time = files, uploaded, now
+            with self.lock:
+                workers = len(self.active) - self.to_retire
+            # Throughput says nothing about the worker count when they're starved
+            if self.task_queue.qsize() < workers:
+                continue
+            self._adjust(workers, rate)
+
+    def _adjust(self, workers, rate):
+        best = self.best_rate
+        improved = best is None or rate[0] > best[0] * IMPROVEMENT or rate[1] > best[1] * IMPROVEMENT
+        degraded = best is not None and rate[0] < best[0] * DEGRADATION and rate[1] < best[1] * DEGRADATION
+
+        if self.last_added and not improved:
+            # The last step didn't help: undo it and stay below it
+            log.info(f"Concurrency: {workers} -> {workers - self.last_added} workers (no throughput gain)")
+            self._retire(self.last_added)
+            self.ceiling = workers - self.last_added
+            self.last_added = 0
+            return
+
+        if improved:
+            self.best_rate = rate if best is None else (max(rate[0], best[0]), max(rate[1], best[1]))
+        elif degraded and workers > 1:
+            log.info(f"Concurrency: {workers} -> {workers - 1} workers (throughput dropped)")
+            self._retire(1)
+            self.ceiling = workers - 1
+            self.best_rate = rate
+            return
+
+        step = min(self.ceiling - workers, max(1, workers // 2))
+        self.last_added = max(0, step)
+        if step > 0:
+            log.info(f"Concurrency: {workers} -> {workers + step} workers")
+            self._add(step)
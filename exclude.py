@@ -0,0 +1,146 @@
+import os
+import re
+
+# Patterns in this file at the root of localDir are added to `exclude`
+IGNORE_FILE = '.sftpignore'
+
+def _translate(pattern):
+    """
+    Regex for a glob pattern with fnmatch syntax, where * and ? also match
+    '/' as they do in fnmatch, plus '**/' for zero or more directories.
+    """
+    i, n = 0, len(pattern)
+    out = []
+    while i < n:
+        if pattern.startswith('**/', i):
+            out.append('(?:.*/)?')
+            i += 3
+        elif pattern[i] == '*':
+            out.append('.*')
+            while i < n and pattern[i] == '*':
+                i += 1
+        elif pattern[i] == '?':
+            out.append('.')
+            i += 1
+        elif pattern[i] == '[':
+            # Same rules as fnmatch: a ']' right after '[' or '[!' is literal
+            j = i + 1
+            if j < n and pattern[j] == '!':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            while j < n and pattern[j] != ']':
+                j += 1
+            if j >= n:
+                out.append('\\[')
+                i += 1
+                continue
+            stuff = pattern[i + 1:j].replace('\\', '\\\\')
+            if stuff.startswith('!'):
+                stuff = '^' + stuff[1:]
+            elif stuff.startswith(('^', '[')):
+                stuff = '\\' + stuff
+            out.append(f"[{stuff}]")
+            i = j + 1
+        else:
+            out.append(re.escape(pattern[i]))
+            i += 1
+    return ''.join(out)
+
+def _literal_prefix(pattern):
+    """The part of a pattern before its first wildcard."""
+    match = re.search(r'[*?\[]', pattern)
+    return pattern[:match.start()] if match else pattern
+
+def read_ignore_file(path):
+    """Patterns from an ignore file: one per line, blank lines and # comments skipped."""
+    with open(path, encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+
+class ExcludeMatcher:
+    """
+    Decides which paths (relative, '/'-separated) the scan leaves out.
+
+    Patterns use fnmatch syntax against the whole relative path of a file,
+    so existing patterns such as '*.log', 'docs' or 'node_modules/*' keep
+    their meaning, plus:
+
+    - '**/' matches zero or more directories ('**/cache/*').
+    - A trailing '/' matches directories only ('build/').
+    - A leading '!' re-includes what earlier patterns excluded; the last
+      matching pattern wins. As in gitignore, a file can't be re-included
+      if one of its directories is excluded.
+
+    Consecutive patterns of the same kind are compiled into one regex, so a
+    path is checked with a single match per group rather than per pattern.
+    A directory is pruned, and never read, only when that provably excludes
+    nothing the files would not: it matches a pattern with a trailing '/'
+    or with '**', or a pattern such as 'dir/*' or 'dir/**' covers
+    everything below it and no negation could reach inside.
+    """
+    def __init__(self, patterns=()):
+        ignore_case = os.path.normcase('A') == 'a'
+        # [(negated, [regexes for files], [for directories], [for whole subtrees])] in pattern order
+        self.groups = []
+        self.negated_prefixes = []
+        self.patterns = []
+        current = None
+        for pattern in patterns:
+            pattern = pattern.strip()
+            negated = pattern.startswith('!')
+            if negated or pattern.startswith('\\!'):
+                pattern = pattern[1:]
+            dir_only = pattern.endswith('/')
+            pattern = pattern.strip('/')
+            if not pattern:
+                continue
+            self.patterns.append(('!' if negated else '') + pattern + ('/' if dir_only else ''))
+            if negated:
+                self.negated_prefixes.append(_literal_prefix(pattern))
+            if current is None or current[0] != negated:
+                current = (negated, [], [], [])
+                self.groups.append(current)
+            regex = _translate(pattern)
+            if not dir_only:
+                current[1].append(regex)
+            # Without a trailing '/' or '**', a pattern is about files only,
+            # as it was with fnmatch ('docs' keeps 'docs/x.txt')
+            if dir_only or '**' in pattern:
+                current[2].append(regex)
+            # 'dir/*' and 'dir/**' match every path below what 'dir' matches
+            head, _, last = pattern.rpartition('/')
+            if head and not dir_only and last in ('*', '**'):
+                current[3].append(_translate(head))
+
+        flags = re.DOTALL | (re.IGNORECASE if ignore_case else 0)
+        self.groups = [
+            (negated, self._compile(file_regexes, flags), self._compile(dir_regexes, flags), self._compile(subtree_regexes, flags))
+            for negated, file_regexes, dir_regexes, subtree_regexes in self.groups
+        ]
+
+    @staticmethod
+    def _compile(regexes, flags):
+        return re.compile(f"(?:{'|'.join(regexes)})\\Z", flags) if regexes else None
+
+    def __bool__(self):
+        return bool(self.groups)
+
+    def _last_match(self, path, is_dir):
+        for negated, file_regex, dir_regex, _ in reversed(self.groups):
+            regex = dir_regex if is_dir else file_regex
+            if regex and regex.match(path):
+                return not negated
+        return False
+
+    def excluded(self, rel_path):
+        """Whether a file is excluded."""
+        return self._last_match(rel_path, False)
+
+    def prunes(self, rel_dir):
+        """Whether a directory is excluded with everything in it."""
+        if self._last_match(rel_dir, True):
+            return True
+        # e.g. 'node_modules/*', unless a negation may reach inside
+        if any(rel_dir.startswith(prefix) or prefix.startswith(rel_dir + '/') for prefix in self.negated_prefixes):
+            return False
+        return any(subtree_regex and subtree_regex.match(rel_dir) for negated, _, _, subtree_regex in self.groups if not negated)
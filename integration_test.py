@@ -4,8 +4,16 @@ import shutil
 import time
 import subprocess
 import tempfile
+import json
+import gzip
+import hashlib
+import io
+import contextlib
 from unittest.mock import patch
 import sys
+import fnmatch
+import posixpath
+import threading
 
 # Add current dir to path to import main
 sys.path.append(os.getcwd())
@@ -15,6 +23,8 @@ except ImportError:
     # If running from a subdir or if main is not found, try adding parent
     sys.path.append(os.path.dirname(os.getcwd()))
     import main
+from scheduler import TaskScheduler
+from utils import HashManager
 
 class TestSFTPAction(unittest.TestCase):
     @classmethod
@@ -155,6 +165,83 @@ class TestSFTPAction(unittest.TestCase):
         self.check_remote_file("keep.txt")
         self.check_remote_file_not_exists("delete.txt")
 
+    def test_delete_empty_dirs(self):
+        print("\n--- Test: Delete Empty Directories ---")
+        self.create_file("old/a/b/x.txt", "x")
+        self.create_file("old/y.txt", "y")
+        self.create_file("mixed/keep.txt", "keep")
+        self.create_file("mixed/gone.txt", "gone")
+        self.create_file("shared/gone.txt", "gone")
+        self.run_action()
+        # Not tracked by the hash file, so its directory must stay
+        with open(os.path.join("test_remote", "shared", "server.txt"), "w") as f:
+            f.write("server")
+
+        shutil.rmtree(os.path.join(self.local_dir, "old"))
+        shutil.rmtree(os.path.join(self.local_dir, "shared"))
+        os.remove(os.path.join(self.local_dir, "mixed", "gone.txt"))
+        self.run_action(INPUT_REMOVEEXTRAFILESONSERVER='true', INPUT_CONCURRENCY='3', INPUT_DETECTMOVES='false')
+
+        self.check_remote_file_not_exists("old")
+        self.check_remote_file_not_exists("mixed/gone.txt")
+        self.check_remote_file_not_exists("shared/gone.txt")
+        self.check_remote_file("mixed/keep.txt", "keep")
+        self.check_remote_file("shared/server.txt", "server")
+
+    def test_delete_retries(self):
+        print("\n--- Test: Delete Retries ---")
+        for path in ("flaky.txt", "stuck.txt", "keep.txt"):
+            self.create_file(path, path)
+        self.run_action()
+        os.remove(os.path.join(self.local_dir, "flaky.txt"))
+        os.remove(os.path.join(self.local_dir, "stuck.txt"))
+
+        real_remove = main.remove_remote_files
+        calls = []
+
+        def remove_remote_files(client_pool, remote_paths, workers):
+            # flaky.txt fails once, stuck.txt every time
+            calls.append(sorted(posixpath.basename(p) for p in remote_paths))
+            failing = [p for p in remote_paths if p.endswith("stuck.txt") or (p.endswith("flaky.txt") and len(calls) == 1)]
+            results = real_remove(client_pool, [p for p in remote_paths if p not in failing], workers)
+            results.update((p, PermissionError(13, "Permission denied")) for p in failing)
+            return results
+
+        report_file = os.path.join(tempfile.mkdtemp(), "report.json")
+        with patch('main.remove_remote_files', side_effect=remove_remote_files):
+            self.run_action(INPUT_REMOVEEXTRAFILESONSERVER='true', INPUT_RETRIES='2', INPUT_RETRYDELAY='0', INPUT_REPORTFILE=report_file)
+
+        self.assertEqual(calls, [["flaky.txt", "stuck.txt"], ["flaky.txt", "stuck.txt"], ["stuck.txt"]])
+        self.check_remote_file_not_exists("flaky.txt")
+        self.check_remote_file("stuck.txt", "stuck.txt")
+        self.check_remote_file("keep.txt", "keep.txt")
+        with open(report_file) as f:
+            counters = json.load(f)['counters']
+        self.assertEqual(counters['files_deleted'], 1)
+        self.assertEqual(counters['files_failed'], 0)
+
+    def test_schedule_order(self):
+        print("\n--- Test: Schedule Order ---")
+        sizes = [5, 1, 9, 3, 9, 7]
+        expected = {
+            'fifo': [0, 1, 2, 3, 4, 5],
+            # Equal sizes keep the order they were found in
+            'largest-first': [2, 4, 5, 0, 3, 1],
+            'interleave': [2, 1, 4, 3, 5, 0],
+        }
+        for policy, order in expected.items():
+            scheduler = TaskScheduler(policy=policy)
+            for i, size in enumerate(sizes[:3]):
+                scheduler.put(('upload', f"file{i}", size, None, None))
+            # Sentinels wait for every task, even ones queued after them
+            scheduler.put(None)
+            for i, size in enumerate(sizes[3:], 3):
+                scheduler.put(('upload', f"file{i}", size, None, None))
+            handed_out = [scheduler.get() for _ in range(len(sizes) + 1)]
+            self.assertEqual(handed_out[:-1], [('upload', f"file{i}", sizes[i], None, None) for i in order], policy)
+            self.assertIsNone(handed_out[-1], policy)
+            self.assertTrue(scheduler.empty(), policy)
+
     def test_exclude(self):
         print("\n--- Test: Exclude ---")
         self.create_file("normal.txt", "normal")
@@ -164,7 +251,40 @@ class TestSFTPAction(unittest.TestCase):
         
         self.check_remote_file("normal.txt")
         self.check_remote_file_not_exists("ignore.tmp")
-        
+
+    def test_exclude_patterns(self):
+        print("\n--- Test: Exclude Patterns ---")
+        self.create_file("app.js", "app")
+        self.create_file("node_modules/lib/index.js", "lib")
+        self.create_file("src/node_modules/dep.js", "dep")
+        self.create_file("logs/a.log", "a")
+        self.create_file("logs/keep.log", "keep")
+        self.create_file("build/out.txt", "out")
+        self.create_file(".sftpignore", "# deploy only sources\nbuild/\n.sftpignore\n")
+
+        self.run_action(INPUT_EXCLUDE='**/node_modules/*, logs/*.log, !logs/keep.log')
+
+        self.check_remote_file("app.js", "app")
+        self.check_remote_file("logs/keep.log", "keep")
+        for path in ["node_modules/lib/index.js", "src/node_modules/dep.js", "logs/a.log", "build/out.txt", ".sftpignore"]:
+            self.check_remote_file_not_exists(path)
+
+    def test_exclude_fnmatch_compat(self):
+        print("\n--- Test: Exclude Patterns Match Like fnmatch ---")
+        patterns = ['docs', '*.d', 'cache/*[!p]', 'keys/[x]', 'tmp/*']
+        paths = ["docs/index.html", "conf.d/site.conf", "a.d", "cache/p", "cache/q",
+                 "keys/x", "keys/y", "tmp/a/b.txt", "main.txt"]
+        for path in paths:
+            self.create_file(path, path)
+
+        self.run_action(INPUT_EXCLUDE=', '.join(patterns))
+
+        for path in paths:
+            if any(fnmatch.fnmatch(path, pattern) for pattern in patterns):
+                self.check_remote_file_not_exists(path)
+            else:
+                self.check_remote_file(path, path)
+
     def test_dry_run(self):
         print("\n--- Test: Dry Run ---")
         self.create_file("test.txt", "test")
@@ -173,5 +293,482 @@ class TestSFTPAction(unittest.TestCase):
         
         self.check_remote_file_not_exists("test.txt")
 
+    def test_connection_pool(self):
+        print("\n--- Test: Connection Pool ---")
+        for i in range(6):
+            self.create_file(f"dir{i % 2}/file{i}.txt", f"content{i}")
+
+        self.run_action(INPUT_CONNECTIONS='2', INPUT_CHANNELSPERCONNECTION='2')
+
+        for i in range(6):
+            self.check_remote_file(f"dir{i % 2}/file{i}.txt", f"content{i}")
+
+    def test_hash_cache(self):
+        print("\n--- Test: Hash Cache ---")
+        cache_path = os.path.join(tempfile.mkdtemp(), "hash_cache.json")
+        self.create_file("file1.txt", "content1")
+        self.run_action(INPUT_HASHCACHE=cache_path)
+        self.assertTrue(os.path.exists(cache_path))
+
+        # Unchanged stat: skipped from cache
+        remote_file = os.path.join("test_remote", "file1.txt")
+        mtime1 = os.path.getmtime(remote_file)
+        time.sleep(1.1)
+        self.run_action(INPUT_HASHCACHE=cache_path)
+        self.assertEqual(mtime1, os.path.getmtime(remote_file), "File should NOT have been updated")
+
+        # Changed content: re-hashed and uploaded
+        self.create_file("file1.txt", "content1_modified")
+        self.run_action(INPUT_HASHCACHE=cache_path)
+        self.check_remote_file("file1.txt", "content1_modified")
+
+    def test_hash_algorithm_migration(self):
+        print("\n--- Test: Hash Algorithm Migration ---")
+        self.create_file("file1.txt", "content1")
+        self.run_action()
+
+        remote_file = os.path.join("test_remote", "file1.txt")
+        mtime1 = os.path.getmtime(remote_file)
+        time.sleep(1.1)
+
+        # Switching algorithms must not re-upload unchanged files
+        self.run_action(INPUT_HASHALGORITHM='sha256')
+        self.assertEqual(mtime1, os.path.getmtime(remote_file), "File should NOT have been updated")
+
+        with gzip.open(os.path.join("test_remote", ".sftp_upload_action_hashes")) as f:
+            manifest = json.load(f)
+        self.assertEqual(manifest['algorithm'], 'sha256')
+        self.assertEqual(manifest['files']['file1.txt'], hashlib.sha256(b"content1").hexdigest())
+
+    def test_sharded_hash_file(self):
+        print("\n--- Test: Sharded Hash File ---")
+        self.create_file("root.txt", "root")
+        self.create_file("a/file1.txt", "content1")
+        self.create_file("b/file2.txt", "content2")
+        self.run_action(INPUT_HASHFILESHARDS='true')
+
+        shard_dir = os.path.join("test_remote", ".sftp_upload_action_hashes.d")
+        self.assertEqual(len(os.listdir(shard_dir)), 3)
+
+        remote_file = os.path.join("test_remote", "a", "file1.txt")
+        mtime1 = os.path.getmtime(remote_file)
+        time.sleep(1.1)
+
+        # Only the changed file is uploaded again
+        self.create_file("b/file2.txt", "content2_modified")
+        self.run_action(INPUT_HASHFILESHARDS='true')
+        self.assertEqual(mtime1, os.path.getmtime(remote_file), "File should NOT have been updated")
+        self.check_remote_file("b/file2.txt", "content2_modified")
+
+    def test_shard_loaded_during_checkpoint(self):
+        print("\n--- Test: Shard Loaded During Checkpoint ---")
+        self.create_file("a/file1.txt", "content1")
+        self.create_file("b/file2.txt", "content2")
+        self.run_action(INPUT_HASHFILESHARDS='true')
+
+        def slow_loader(remote_path):
+            time.sleep(0.5)
+            with open(os.path.join("test_remote", remote_path), "rb") as f:
+                return f.read()
+
+        hash_manager = HashManager(".sftp_upload_action_hashes", sharded=True)
+        with open(os.path.join("test_remote", ".sftp_upload_action_hashes"), "rb") as f:
+            hash_manager.load(f.read())
+        hash_manager.shard_loader = slow_loader
+        lookups = {}
+        first = threading.Thread(target=lambda: lookups.setdefault("first", hash_manager.get_remote_hash("a/file1.txt")))
+        first.start()
+        time.sleep(0.1)
+        # Another worker and a checkpoint, while shard 'a' is being downloaded
+        second = threading.Thread(target=lambda: lookups.setdefault("second", hash_manager.get_remote_hash("a/file1.txt")))
+        second.start()
+        written = {}
+        hash_manager.save(lambda remote_path, content: written.setdefault(remote_path, content))
+        first.join()
+        second.join()
+
+        expected = hashlib.md5(b"content1").hexdigest()
+        self.assertEqual(lookups, {"first": expected, "second": expected})
+        index = json.loads(gzip.decompress(written[".sftp_upload_action_hashes"]))
+        self.assertEqual(set(index['shards']), {"a", "b"})
+
+    def test_chunked_upload(self):
+        print("\n--- Test: Chunked Upload ---")
+        content = "".join(f"line {i}\n" for i in range(20000))
+        self.create_file("big.txt", content)
+        self.create_file("small.txt", "small")
+
+        self.run_action(INPUT_CHUNKEDUPLOADTHRESHOLD='16K', INPUT_CHUNKEDUPLOADPARTS='3')
+
+        self.check_remote_file("big.txt", content)
+        self.check_remote_file("small.txt", "small")
+
+    def test_batched_confirm(self):
+        print("\n--- Test: Batched Confirm ---")
+        for i in range(5):
+            self.create_file(f"sub/file{i}.txt", f"content{i}")
+
+        self.run_action(INPUT_CONFIRMUPLOAD='false', INPUT_BUFFERSIZE='4K', INPUT_WINDOWSIZE='4M')
+
+        for i in range(5):
+            self.check_remote_file(f"sub/file{i}.txt", f"content{i}")
+
+    def test_failed_run_keeps_progress(self):
+        print("\n--- Test: Failed Run Keeps Progress ---")
+        # A remote file where a directory is needed makes one upload fail
+        with open(os.path.join("test_remote", "blocker"), "w") as f:
+            f.write("not a directory")
+        self.create_file("ok.txt", "ok")
+        self.create_file("blocker/file.txt", "blocked")
+
+        with self.assertRaises(SystemExit):
+            self.run_action(INPUT_RETRIES='1', INPUT_RETRYDELAY='0.1')
+
+        with gzip.open(os.path.join("test_remote", ".sftp_upload_action_hashes")) as f:
+            manifest = json.load(f)
+        self.assertIn("ok.txt", manifest['files'])
+        self.assertNotIn("blocker/file.txt", manifest['files'])
+
+    def test_metrics_report(self):
+        print("\n--- Test: Metrics Report ---")
+        self.create_file("a.txt", "aaaa")
+        self.create_file("sub/b.txt", "bb")
+        self.run_action()
+
+        self.create_file("a.txt", "changed")
+        report_file = os.path.join(tempfile.mkdtemp(), "report.json")
+        summary_file = report_file + ".md"
+        with patch.dict(os.environ, {'GITHUB_STEP_SUMMARY': summary_file}):
+            self.run_action(INPUT_REPORTFILE=report_file)
+
+        with open(report_file) as f:
+            report = json.load(f)
+        self.assertEqual(report['counters']['files_uploaded'], 1)
+        self.assertEqual(report['counters']['bytes_uploaded'], 7)
+        self.assertEqual(report['counters']['files_skipped'], 1)
+        self.assertIn('upload', report['phases'])
+        self.assertEqual(report['slowest_files'][0]['path'], "a.txt")
+        with open(summary_file) as f:
+            self.assertIn("| upload |", f.read())
+
+    def test_log_levels(self):
+        print("\n--- Test: Log Levels ---")
+        self.create_file("a.txt", "a")
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.run_action(INPUT_LOGLEVEL='quiet')
+        self.assertNotIn("a.txt", output.getvalue())
+        self.assertIn("Processing completed", output.getvalue())
+
+        self.create_file("a.txt", "changed")
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.run_action(INPUT_LOGLEVEL='verbose')
+        self.assertIn("Uploading: a.txt", output.getvalue())
+
+    def test_move_detection(self):
+        print("\n--- Test: Move Detection ---")
+        self.create_file("old/moved.txt", "moved content")
+        self.create_file("old/kept.txt", "kept")
+        self.create_file("gone/deep/only.txt", "only content")
+        self.run_action(INPUT_REMOVEEXTRAFILESONSERVER='true')
+
+        os.makedirs(os.path.join(self.local_dir, "new"))
+        shutil.move(os.path.join(self.local_dir, "old/moved.txt"), os.path.join(self.local_dir, "new/moved.txt"))
+        shutil.move(os.path.join(self.local_dir, "gone/deep/only.txt"), os.path.join(self.local_dir, "new/only.txt"))
+        shutil.rmtree(os.path.join(self.local_dir, "gone"))
+        report_file = os.path.join(tempfile.mkdtemp(), "report.json")
+        self.run_action(INPUT_REMOVEEXTRAFILESONSERVER='true', INPUT_REPORTFILE=report_file)
+
+        self.check_remote_file("new/moved.txt", "moved content")
+        self.check_remote_file_not_exists("old/moved.txt")
+        self.check_remote_file("old/kept.txt", "kept")
+        # Emptied by the move alone
+        self.check_remote_file_not_exists("gone")
+        with open(report_file) as f:
+            report = json.load(f)
+        self.assertEqual(report['counters']['files_moved'], 2)
+        self.assertEqual(report['counters']['files_uploaded'], 0)
+
+    def test_move_failed(self):
+        print("\n--- Test: Move Failed ---")
+        self.create_file("old/moved.txt", "moved content")
+        self.run_action(INPUT_REMOVEEXTRAFILESONSERVER='true')
+
+        shutil.move(os.path.join(self.local_dir, "old"), os.path.join(self.local_dir, "new"))
+        report_file = os.path.join(tempfile.mkdtemp(), "report.json")
+        with patch('paramiko.SFTPClient.posix_rename', side_effect=IOError("rename not allowed")):
+            self.run_action(INPUT_REMOVEEXTRAFILESONSERVER='true', INPUT_REPORTFILE=report_file)
+
+        # Uploaded instead, and the old copy is deleted like any extra file
+        self.check_remote_file("new/moved.txt", "moved content")
+        self.check_remote_file_not_exists("old")
+        with open(report_file) as f:
+            counters = json.load(f)['counters']
+        self.assertEqual(counters['files_moved'], 0)
+        self.assertEqual(counters['files_uploaded'], 1)
+        self.assertEqual(counters['files_deleted'], 1)
+
+    def test_deduplicate(self):
+        print("\n--- Test: Deduplicate ---")
+        for path in ("a.txt", "b.txt", "sub/c.txt"):
+            self.create_file(path, "same content")
+        self.create_file("d.txt", "other content")
+        self.run_action(INPUT_DEDUPLICATE='true', INPUT_CONCURRENCY='2')
+
+        for path in ("a.txt", "b.txt", "sub/c.txt"):
+            self.check_remote_file(path, "same content")
+        self.check_remote_file("d.txt", "other content")
+        inodes = {os.stat(os.path.join("test_remote", p)).st_ino for p in ("a.txt", "b.txt", "sub/c.txt")}
+        self.assertEqual(len(inodes), 1)
+
+        # Changing one of the linked files must not change the others
+        self.create_file("a.txt", "new content")
+        self.run_action(INPUT_DEDUPLICATE='true')
+        self.check_remote_file("a.txt", "new content")
+        self.check_remote_file("b.txt", "same content")
+        self.check_remote_file("sub/c.txt", "same content")
+
+    def test_deduplicate_without_links(self):
+        print("\n--- Test: Deduplicate Without Links ---")
+        for path in ("a.txt", "b.txt", "sub/c.txt"):
+            self.create_file(path, "same content")
+        report_file = os.path.join(tempfile.mkdtemp(), "report.json")
+        # A server without hardlink@openssh.com and posix-rename@openssh.com
+        with patch('main.links_supported', return_value=False):
+            self.run_action(INPUT_DEDUPLICATE='true', INPUT_REPORTFILE=report_file)
+
+        for path in ("a.txt", "b.txt", "sub/c.txt"):
+            self.check_remote_file(path, "same content")
+        with open(report_file) as f:
+            counters = json.load(f)['counters']
+        self.assertEqual(counters['files_uploaded'], 3)
+        self.assertEqual(counters['files_failed'], 0)
+        leftovers = [name for _, _, names in os.walk("test_remote") for name in names if name.endswith(".tmp")]
+        self.assertEqual(leftovers, [])
+
+    def test_deduplicate_turned_off(self):
+        print("\n--- Test: Deduplicate Turned Off ---")
+        self.create_file("a.txt", "same content")
+        self.create_file("b.txt", "same content")
+        self.run_action(INPUT_DEDUPLICATE='true')
+        self.assertEqual(os.stat(os.path.join("test_remote", "a.txt")).st_ino, os.stat(os.path.join("test_remote", "b.txt")).st_ino)
+
+        # The link is still there, so the upload must replace a.txt, not write into it
+        self.create_file("a.txt", "changed")
+        self.run_action()
+        self.check_remote_file("a.txt", "changed")
+        self.check_remote_file("b.txt", "same content")
+
+        # Also when the hashes are ignored
+        self.create_file("a.txt", "same content")
+        self.run_action(INPUT_DEDUPLICATE='true')
+        self.create_file("b.txt", "changed again")
+        self.run_action(INPUT_FORCEUPLOAD='true')
+        self.check_remote_file("a.txt", "same content")
+        self.check_remote_file("b.txt", "changed again")
+
+    def test_release_ids_by_time(self):
+        print("\n--- Test: Releases Ordered By Time ---")
+        now = time.time()
+        # Commit-like ids, whose names don't sort by age
+        for age, release_id in ((200, 'c3f'), (100, 'a91')):
+            self.create_file("index.html", release_id)
+            self.run_action(INPUT_RELEASEMODE='true', INPUT_RELEASEID=release_id)
+            os.utime(os.path.join("test_remote", "releases", release_id), (now - age, now - age))
+
+        self.create_file("index.html", "b07")
+        self.run_action(INPUT_RELEASEMODE='true', INPUT_RELEASEID='b07', INPUT_KEEPRELEASES='2')
+
+        self.check_remote_file("current/index.html", "b07")
+        self.check_remote_file("releases/a91/index.html", "a91")
+        self.check_remote_file_not_exists("releases/c3f")
+
+    def test_release_mode(self):
+        print("\n--- Test: Release Mode ---")
+        self.create_file("index.html", "v1")
+        self.create_file("assets/app.js", "app")
+        self.run_action(INPUT_RELEASEMODE='true', INPUT_RELEASEID='001')
+        self.assertEqual(os.readlink(os.path.join("test_remote", "current")), "releases/001")
+        self.check_remote_file("current/index.html", "v1")
+
+        self.create_file("index.html", "v2")
+        report_file = os.path.join(tempfile.mkdtemp(), "report.json")
+        self.run_action(INPUT_RELEASEMODE='true', INPUT_RELEASEID='002', INPUT_KEEPRELEASES='1', INPUT_REPORTFILE=report_file)
+        self.assertEqual(os.readlink(os.path.join("test_remote", "current")), "releases/002")
+        self.check_remote_file("current/index.html", "v2")
+        self.check_remote_file("current/assets/app.js", "app")
+        self.check_remote_file_not_exists("releases/001")
+
+        # The unchanged file was linked from the previous release, not uploaded
+        with open(report_file) as f:
+            counters = json.load(f)['counters']
+        self.assertEqual(counters['files_uploaded'], 1)
+        self.assertEqual(counters['files_reused'], 1)
+        with gzip.open(os.path.join("test_remote", "releases/002/.sftp_upload_action_hashes")) as f:
+            self.assertEqual(set(json.load(f)['files']), {"index.html", "assets/app.js"})
+
+        # Nothing in a new release is a hard link yet, so uploads are written in place
+        self.create_file("index.html", "v3")
+        with patch('main.temporary_path', wraps=main.temporary_path) as temporary_path:
+            self.run_action(INPUT_RELEASEMODE='true', INPUT_RELEASEID='003')
+        temporary_path.assert_not_called()
+        self.check_remote_file("current/index.html", "v3")
+        self.check_remote_file("current/assets/app.js", "app")
+
+    def test_tar_batches(self):
+        print("\n--- Test: Tar Batches ---")
+        for i in range(20):
+            self.create_file(f"small/dir{i % 3}/file{i}.txt", f"small{i}")
+        self.create_file("large.txt", "x" * 4096)
+        self.run_action(INPUT_TARTHRESHOLD='1K', INPUT_TARBATCHFILES='8')
+
+        for i in range(20):
+            self.check_remote_file(f"small/dir{i % 3}/file{i}.txt", f"small{i}")
+        self.check_remote_file("large.txt", "x" * 4096)
+        # Whether sent as tar or one by one, every file is in the hash file
+        with gzip.open(os.path.join("test_remote", ".sftp_upload_action_hashes")) as f:
+            self.assertEqual(len(json.load(f)['files']), 21)
+
+    def test_pipelined_engine(self):
+        print("\n--- Test: Pipelined Engine ---")
+        for i in range(150):
+            self.create_file(f"small/dir{i % 4}/file{i}.txt", f"small{i}" * (i + 1))
+        self.create_file("empty.txt", "")
+        self.create_file("large.txt", "x" * (2 * 1024 * 1024))
+        report_file = os.path.join(tempfile.mkdtemp(), "report.json")
+        self.run_action(INPUT_ENGINE='pipelined', INPUT_CONCURRENCY='2', INPUT_REPORTFILE=report_file)
+
+        for i in range(150):
+            self.check_remote_file(f"small/dir{i % 4}/file{i}.txt", f"small{i}" * (i + 1))
+        self.check_remote_file("empty.txt", "")
+        self.check_remote_file("large.txt", "x" * (2 * 1024 * 1024))
+        with open(report_file) as f:
+            self.assertEqual(json.load(f)['counters']['files_uploaded'], 152)
+
+        # Changed files go through a temporary name when deduplicating
+        self.create_file("small/dir0/file0.txt", "changed")
+        self.create_file("small/dir1/file1.txt", "changed too")
+        self.create_file("copy.txt", "changed")
+        self.run_action(INPUT_ENGINE='pipelined', INPUT_DEDUPLICATE='true', INPUT_CONFIRMUPLOAD='false')
+        self.check_remote_file("small/dir0/file0.txt", "changed")
+        self.check_remote_file("small/dir1/file1.txt", "changed too")
+        self.check_remote_file("copy.txt", "changed")
+
+    def test_directory_stage(self):
+        print("\n--- Test: Directory Stage ---")
+        for i in range(12):
+            self.create_file(f"a/b{i % 3}/c/file{i}.txt", f"file{i}")
+        report_file = os.path.join(tempfile.mkdtemp(), "report.json")
+        self.run_action(INPUT_CONCURRENCY='4', INPUT_REPORTFILE=report_file)
+        for i in range(12):
+            self.check_remote_file(f"a/b{i % 3}/c/file{i}.txt", f"file{i}")
+        with open(report_file) as f:
+            # a, a/b0..2 and a/b0..2/c, each created once, by the directory stage or a worker
+            self.assertEqual(json.load(f)['counters']['dirs_created'], 7)
+
+        # Directories of tracked files are known from the hash file
+        self.create_file("a/b0/c/new.txt", "new")
+        self.create_file("a/b0/d/new.txt", "new")
+        self.run_action(INPUT_REPORTFILE=report_file)
+        self.check_remote_file("a/b0/c/new.txt", "new")
+        self.check_remote_file("a/b0/d/new.txt", "new")
+        with open(report_file) as f:
+            self.assertEqual(json.load(f)['counters']['dirs_created'], 1)
+
+    def test_directory_deleted_on_server(self):
+        print("\n--- Test: Directory Deleted On Server ---")
+        self.create_file("a/b/c/f.txt", "f")
+        self.create_file("a/b/g.txt", "g")
+        self.run_action()
+
+        # The hash file still says a/b/c exists
+        shutil.rmtree(os.path.join("test_remote", "a"))
+        self.create_file("a/b/c/f.txt", "f2")
+        self.run_action(INPUT_RETRYDELAY='0')
+        self.check_remote_file("a/b/c/f.txt", "f2")
+
+        shutil.rmtree(os.path.join("test_remote", "a"))
+        self.run_action(INPUT_VERIFYREMOTE='true', INPUT_RETRYDELAY='0')
+        self.check_remote_file("a/b/c/f.txt", "f2")
+        self.check_remote_file("a/b/g.txt", "g")
+
+    def test_auto_concurrency(self):
+        print("\n--- Test: Auto Concurrency ---")
+        for i in range(300):
+            self.create_file(f"auto/file{i}.txt", f"auto{i}" * 100)
+        report_file = os.path.join(tempfile.mkdtemp(), "report.json")
+        # Measure often so the worker count changes within the run
+        with patch('concurrency.AUTO_INTERVAL', 0.05):
+            self.run_action(INPUT_CONCURRENCY='auto', INPUT_REPORTFILE=report_file)
+
+        for i in range(300):
+            self.check_remote_file(f"auto/file{i}.txt", f"auto{i}" * 100)
+        with open(report_file) as f:
+            report = json.load(f)
+        self.assertEqual(report['counters']['files_uploaded'], 300)
+        self.assertGreaterEqual(len(report['workers']), 2)
+
+    def test_ciphers_and_compression(self):
+        print("\n--- Test: Ciphers and Compression ---")
+        random_content = os.urandom(64 * 1024)
+        with open(os.path.join(self.local_dir, "random.bin"), "wb") as f:
+            f.write(random_content)
+        self.create_file("text.txt", "compressible " * 5000)
+
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            self.run_action(INPUT_CIPHERS='auto', INPUT_COMPRESSION='auto', INPUT_LOGLEVEL='verbose')
+        self.assertIn("Negotiated: aes", output.getvalue())
+        self.assertIn("Uploading (uncompressed): random.bin", output.getvalue())
+        self.check_remote_file("text.txt", "compressible " * 5000)
+        with open(os.path.join("test_remote", "random.bin"), "rb") as f:
+            self.assertEqual(f.read(), random_content)
+
+        with self.assertRaises(SystemExit):
+            self.run_action(INPUT_CIPHERS='no-such-cipher')
+
+    def test_verify_remote(self):
+        print("\n--- Test: Verify Remote ---")
+        self.create_file("edited.txt", "original")
+        self.create_file("sub/deleted.txt", "deleted")
+        self.create_file("untouched.txt", "untouched")
+        self.run_action()
+
+        # Edit one file on the server after the deploy and delete another
+        edited_path = os.path.join("test_remote", "edited.txt")
+        with open(edited_path, "w") as f:
+            f.write("tampered")
+        later = time.time() + 10
+        os.utime(edited_path, (later, later))
+        os.remove(os.path.join("test_remote", "sub", "deleted.txt"))
+
+        report_file = os.path.join(tempfile.mkdtemp(), "report.json")
+        self.run_action(INPUT_VERIFYREMOTE='true', INPUT_REPORTFILE=report_file)
+        self.check_remote_file("edited.txt", "original")
+        self.check_remote_file("sub/deleted.txt", "deleted")
+        with open(report_file) as f:
+            counters = json.load(f)['counters']
+        self.assertEqual(counters['files_drifted'], 2)
+        self.assertEqual(counters['files_skipped'], 1)
+
+    def test_multiple_hosts(self):
+        print("\n--- Test: Multiple Hosts ---")
+        self.create_file("a.txt", "a")
+        self.create_file("sub/b.txt", "b")
+        report_file = os.path.join(tempfile.mkdtemp(), "report.json")
+
+        # Nothing listens on the second target: the first is deployed anyway
+        with self.assertRaises(SystemExit):
+            self.run_action(INPUT_HOST='localhost, 127.0.0.1:1', INPUT_REPORTFILE=report_file)
+        self.check_remote_file("a.txt", "a")
+        self.check_remote_file("sub/b.txt", "b")
+        with open(report_file) as f:
+            report = json.load(f)
+        self.assertFalse(report['targets']['localhost']['failed'])
+        self.assertTrue(report['targets']['127.0.0.1:1']['failed'])
+        self.assertEqual(report['counters']['files_uploaded'], 2)
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,101 @@
+import collections
+import contextlib
+import sys
+import threading
+
+LOG_LEVELS = ('quiet', 'summary', 'verbose')
+
+# How often buffered lines are written out, in seconds
+FLUSH_INTERVAL = 0.5
+
+class Logger:
+    """
+    Run log with three levels:
+
+    - quiet: errors, warnings and the final result only.
+    - summary: also run-level messages and periodic progress lines.
+    - verbose: also a line for every file.
+
+    Once started, messages from any thread are appended to a deque (atomic,
+    no lock) and written out in batches by a flusher thread, so workers
+    never contend on stdout. Before start() and after stop() lines are
+    printed directly. Lines logged inside tagged(name) are prefixed with
+    [name], per thread.
+    """
+    def __init__(self, level='summary'):
+        self.set_level(level)
+        self.context = threading.local()
+        self.buffer = collections.deque()
+        self.stop_event = threading.Event()
+        self.flusher = None
+
+    def set_level(self, level):
+        if level not in LOG_LEVELS:
+            raise ValueError(f"Unknown log level: {level}. Supported: {', '.join(LOG_LEVELS)}.")
+        self.level = LOG_LEVELS.index(level)
+
+    @contextlib.contextmanager
+    def tagged(self, tag):
+        previous = getattr(self.context, 'tag', None)
+        self.context.tag = tag
+        try:
+            yield
+        finally:
+            self.context.tag = previous
+
+    def _emit(self, message):
+        tag = getattr(self.context, 'tag', None)
+        if tag:
+            message = f"[{tag}] {message}"
+        if self.flusher:
+            self.buffer.append(message)
+        else:
+            print(message)
+
+    def error(self, message):
+        self._emit(message)
+
+    def warning(self, message):
+        self._emit(message)
+
+    def result(self, message):
+        self._emit(message)
+
+    def info(self, message):
+        if self.level >= LOG_LEVELS.index('summary'):
+            self._emit(message)
+
+    def detail(self, message):
+        if self.level >= LOG_LEVELS.index('verbose'):
+            self._emit(message)
+
+    def flush(self):
+        lines = []
+        try:
+            while True:
+                lines.append(self.buffer.popleft())
+        except IndexError:
+            pass
+        if lines:
+            # Looked up on every flush so redirected stdout is honoured
+            sys.stdout.write('\n'.join(lines) + '\n')
+            sys.stdout.flush()
+
+    def _flush_task(self):
+        while not self.stop_event.wait(FLUSH_INTERVAL):
+            self.flush()
+
+    def start(self):
+        self.stop_event.clear()
+        self.flusher = threading.Thread(target=self._flush_task, daemon=True)
+        self.flusher.start()
+
+    def stop(self):
+        if self.flusher:
+            self.stop_event.set()
+            self.flusher.join()
+            self.flusher = None
+        self.flush()
+
+# Shared by all modules; main() sets the level and starts the flusher
+log = Logger()
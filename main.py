@@ -2,104 +2,1074 @@ import os
 import sys
 import argparse
 import time
+import types
 import threading
 import queue
+import collections
+import posixpath
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, as_completed, wait
 
-# Set stdout to be line buffered so logs appear immediately
-sys.stdout.reconfigure(line_buffering=True)
+from utils import MANIFEST_COMPRESSIONS, HashManager, StatCache, compress_manifest, compute_file_hashes, is_compressible, iter_directory, new_hasher, parse_size
+from scheduler import SCHEDULE_POLICIES, DuplicateTracker, TarBatcher, TaskScheduler
+from metrics import Metrics, combine_reports, format_bytes
+from logger import LOG_LEVELS, log
+from release import activate_release, current_release, prune_releases, release_path
+from exclude import IGNORE_FILE, ExcludeMatcher, read_ignore_file
+from concurrency import AUTO_INITIAL_WORKERS, AUTO_MAX_WORKERS, ConcurrencyController
+from sftp_client import CHUNK_READ_SIZE, COMPRESSION_POLICIES, ENGINE_WINDOW, ENGINES, DirectoryCache, SFTPConnectionPool, UnsupportedOperation, benchmark_ciphers, supported_algorithms, upload_file_chunked, upload_file_with_client, ensure_dir_exists, hardlink, links_supported, list_remote_tree, make_remote_dirs, remove_empty_dirs, remove_remote_files, temporary_path, upload_files_pipelined, upload_files_tar, verify_remote_sizes
 
-from utils import HashManager, compute_file_hash, scan_directory
-from sftp_client import SFTPClientWrapper, upload_file_with_client, ensure_dir_exists
+# Number of files sent to a hashing process at a time
+HASH_BATCH_SIZE = 16
 
-def worker_task(worker_id, client_wrapper, task_queue, result_queue, error_list, local_dir, remote_dir, dry_run, hash_manager, force_upload):
+# Capacity of the queues between the scan, hash and upload stages
+SCAN_QUEUE_SIZE = 1000
+UPLOAD_QUEUE_SIZE = 1000
+
+# Seconds between progress lines
+PROGRESS_INTERVAL = 10
+
+# Upper bound on the content of one tar or pipelined batch of small files
+TAR_BATCH_BYTES = 32 * 1024 * 1024
+
+# With the pipelined engine, changed files smaller than this are uploaded
+# in batches of up to PIPELINED_BATCH_FILES, one batch per worker at a time
+PIPELINED_FILE_BYTES = 1024 * 1024
+PIPELINED_BATCH_FILES = 100
+
+def worker_task(worker_id, client_pool, task_queue, error_list, local_dir, remote_dir, dry_run, hash_manager, chunk_threshold=0, chunk_parts=4, buffer_size=CHUNK_READ_SIZE, unconfirmed=None, retries=3, retry_delay=1.0, metrics=None, dedup=None, controller=None, dir_cache=None, atomic_writes=False, moved=None):
     """
-    Worker thread to process upload and delete tasks using a persistent SFTP connection.
-    Also handles hash computation and checking.
+    Worker thread to process upload, move and link tasks using a persistent SFTP connection.
+    Only files already known to have changed are queued, so every task is real work.
+    Each completed task is recorded in the hash manager so checkpoints only
+    ever contain work that actually finished.
+    Files of at least chunk_threshold bytes are uploaded in chunk_parts parallel ranges.
+    When an unconfirmed list is given, uploads skip their confirming stat and
+    record (rel_path, remote_path, size) there for a batched check at the end.
+    Failed tasks are retried with exponential backoff, reconnecting first if
+    the channel or connection died. With a DuplicateTracker, the duplicates
+    of a file are hard-linked to it once it is uploaded, reuse tasks
+    hard-link files from the previous release. With atomic_writes, uploads
+    go to a temporary name first, for paths that may be hard links. Exits
+    when it receives a None sentinel, or between tasks when the
+    ConcurrencyController retires it. Directories in dir_cache, shared with
+    the other workers, are taken to exist. The source of every move that
+    succeeded is added to the moved set.
     """
+    metrics = metrics or Metrics()
     try:
-        # Create a new SFTP client/channel for this worker
-        sftp = client_wrapper.create_sftp()
+        # Create a new SFTP client/channel for this worker on its pool member
+        sftp = client_pool.create_sftp(worker_id)
     except Exception as e:
-        print(f"[Worker {worker_id}] Failed to create SFTP client: {e}")
+        # Hitting the server's channel limit only caps an automatic worker count
+        if controller and controller.channel_failed(worker_id, e):
+            return
+        log.error(f"[Worker {worker_id}] Failed to create SFTP client: {e}")
         error_list.append(e)
         return
 
-    dir_cache = set()
+    metrics.worker_started(worker_id)
+    dir_cache = DirectoryCache() if dir_cache is None else dir_cache
+    moved = set() if moved is None else moved
+    # Channel on the uncompressed connection (compression: auto), opened on first use
+    plain_sftp = None
 
-    try:
-        while True:
+    def plain_channel():
+        nonlocal plain_sftp
+        if plain_sftp is None or plain_sftp.get_channel().closed:
+            plain_sftp = client_pool.create_sftp(worker_id, compressed=False)
+        return plain_sftp
+
+    def with_retries(operation, rel_path):
+        nonlocal sftp
+        for attempt in range(retries + 1):
             try:
-                task = task_queue.get_nowait()
-            except queue.Empty:
-                break
-            
-            # Unpack task
-            if isinstance(task, tuple):
-                action, rel_path = task
-            else:
-                action = 'upload'
-                rel_path = task
+                if attempt and (not client_pool.is_active(worker_id) or sftp.get_channel().closed):
+                    log.warning(f"[Worker {worker_id}] Connection lost, reconnecting...")
+                    sftp.close()
+                    sftp = client_pool.create_sftp(worker_id)
+                return operation()
+            except Exception as e:
+                if isinstance(e, FileNotFoundError):
+                    # The directory may have been removed on the server since it was cached
+                    dir_cache.discard(posixpath.dirname(remote_path_of(rel_path)))
+                if attempt >= retries:
+                    raise
+                delay = retry_delay * (2 ** attempt)
+                log.warning(f"[Worker {worker_id}] Attempt {attempt + 1} failed for {rel_path}: {e}. Retrying in {delay:.1f}s...")
+                time.sleep(delay)
 
-            if action == 'delete':
-                print(f"[Worker {worker_id}] Processing Delete: {rel_path}")
-                remote_path = os.path.join(remote_dir, rel_path).replace('\\', '/')
-                
-                try:
-                    if dry_run:
-                        print(f"[Worker {worker_id}] Dry run: Would remove {rel_path}")
-                    else:
-                        print(f"[Worker {worker_id}] Removing: {rel_path}")
+    def ensure_dir(path):
+        # Counted with those the directory stage creates
+        metrics.add('dirs_created', ensure_dir_exists(sftp, path, dir_cache))
+
+    def remove_quietly(path):
+        # Cleanup after a failure, which may have taken the channel with it
+        try:
+            sftp.remove(path)
+        except Exception:
+            pass
+
+    def remote_path_of(path):
+        # Link sources may point into a sibling release directory via '..'
+        return posixpath.normpath(os.path.join(remote_dir, path).replace('\\', '/'))
+
+    def process(task):
+        action, rel_path, size, file_hash, source = task
+        task_start = time.time()
+        remote_path = remote_path_of(rel_path)
+        remote_parent = os.path.dirname(remote_path)
+
+        if action == 'move':
+            # Same content as a file that disappeared locally: rename the
+            # remote copy instead of uploading it again
+            try:
+                if dry_run:
+                    log.detail(f"[Worker {worker_id}] Dry run: Would move {source} to {rel_path}")
+                    moved.add(source)
+                else:
+                    log.detail(f"[Worker {worker_id}] Moving: {source} -> {rel_path}")
+                    ensure_dir(remote_parent)
+                    sftp.posix_rename(remote_path_of(source), remote_path)
+                    hash_manager.remove_hash(source)
+                    hash_manager.update_local_hash(rel_path, file_hash)
+                    moved.add(source)
+                    metrics.add('files_moved')
+                    metrics.record_task(worker_id, 'move', rel_path, size, task_start)
+                return
+            except Exception as e:
+                log.warning(f"[Worker {worker_id}] Warning: Failed to move {source} to {rel_path}, uploading it instead: {e}")
+
+        if action in ('link', 'reuse'):
+            # Same content as a file already on the server, in this run
+            # (link) or in the previous release (reuse)
+            try:
+                if dry_run:
+                    log.detail(f"[Worker {worker_id}] Dry run: Would link {rel_path} to {source}")
+                    return
+                if dedup.hardlinks:
+                    log.detail(f"[Worker {worker_id}] Linking: {rel_path} -> {source}")
+                    ensure_dir(remote_parent)
+                    if atomic_writes:
+                        temp_path = temporary_path(remote_path, worker_id)
+                        hardlink(sftp, remote_path_of(source), temp_path)
                         try:
-                            sftp.remove(remote_path)
-                            print(f"[Worker {worker_id}] Removed: {rel_path}")
-                        except IOError as e:
-                            # If file doesn't exist, that's fine
-                            print(f"[Worker {worker_id}] Warning: Failed to remove {rel_path} (maybe already gone): {e}")
-                except Exception as e:
-                     print(f"[Worker {worker_id}] Error removing {rel_path}: {e}")
-                     error_list.append(e)
-                finally:
-                    task_queue.task_done()
-                continue
+                            sftp.posix_rename(temp_path, remote_path)
+                        except Exception:
+                            remove_quietly(temp_path)
+                            raise
+                    else:
+                        hardlink(sftp, remote_path_of(source), remote_path)
+                    hash_manager.update_local_hash(rel_path, file_hash)
+                    if action == 'link':
+                        metrics.add('files_linked')
+                        metrics.add('bytes_deduplicated', size)
+                    else:
+                        metrics.add('files_reused')
+                    metrics.record_task(worker_id, 'link', rel_path, size, task_start)
+                    return
+            except UnsupportedOperation as e:
+                # The server lacks the extension, don't try again
+                dedup.hardlinks = False
+                log.warning(f"[Worker {worker_id}] Warning: Failed to link {rel_path} to {source}, uploading duplicates instead: {e}")
+            except Exception as e:
+                log.warning(f"[Worker {worker_id}] Warning: Failed to link {rel_path} to {source}, uploading it instead: {e}")
 
-            # Default action: upload
-            print(f"[Worker {worker_id}] Processing Upload: {rel_path}")
-            local_path = os.path.join(local_dir, rel_path)
-            remote_path = os.path.join(remote_dir, rel_path).replace('\\', '/')
-            remote_parent = os.path.dirname(remote_path)
-            
+        if action == 'tar':
+            # A batch of small files (source) sent as one tar stream over exec
             try:
-                # Compute local hash
-                current_hash = compute_file_hash(local_path)
-                result_queue.put((rel_path, current_hash))
-                print(f"[Worker {worker_id}] Computed hash: {current_hash} for: {rel_path}")
-
-                # Check if skip
-                remote_hash = hash_manager.get_remote_hash(rel_path)
-                
-                if not force_upload and remote_hash == current_hash:
-                    # Hash match, skip
-                    print(f"[Worker {worker_id}] Skipped (no change): {rel_path}")
-                    continue
+                if dry_run:
+                    log.detail(f"[Worker {worker_id}] Dry run: Uploading {rel_path}")
+                    return
+                log.detail(f"[Worker {worker_id}] Uploading {rel_path}")
+                files = [(os.path.join(local_dir, path), path) for path, _, _ in source]
+                upload_files_tar(sftp.get_channel().get_transport(), files, remote_dir)
+                for path, path_size, path_hash in source:
+                    hash_manager.update_local_hash(path, path_hash)
+                    metrics.add('files_uploaded')
+                    metrics.add('bytes_uploaded', path_size)
+                    if dedup:
+                        follow_ups.extend(('link', dup, dup_size, path_hash, path) for dup, dup_size in dedup.finish(path_hash, path))
+                metrics.record_task(worker_id, 'upload', rel_path, size, task_start)
+            except Exception as e:
+                log.warning(f"[Worker {worker_id}] Warning: Tar upload of {rel_path} failed, uploading them one by one: {e}")
+                follow_ups.extend(('upload', path, path_size, path_hash, None) for path, path_size, path_hash in source)
+            return
 
+        if action == 'pipelined':
+            # A batch of small files (source) with their requests interleaved on one channel
+            try:
                 if dry_run:
-                    print(f"[Worker {worker_id}] Dry run: Uploading {rel_path}")
+                    log.detail(f"[Worker {worker_id}] Dry run: Uploading {rel_path}")
+                    return
+                log.detail(f"[Worker {worker_id}] Uploading {rel_path}")
+                paths = {remote_path_of(path): (path, path_size, path_hash) for path, path_size, path_hash in source}
+                for parent in sorted({posixpath.dirname(p) for p in paths}):
+                    ensure_dir(parent)
+                # Hard-linked paths are never written in place, as for single uploads
+                files = [(os.path.join(local_dir, path), temporary_path(final, worker_id) if atomic_writes else final, final) for final, (path, _, _) in paths.items()]
+                results = upload_files_pipelined(sftp, files, confirm=unconfirmed is None)
+            except Exception as e:
+                log.warning(f"[Worker {worker_id}] Warning: Pipelined upload of {rel_path} failed, uploading them one by one: {e}")
+                follow_ups.extend(('upload', path, path_size, path_hash, None) for path, path_size, path_hash in source)
+                return
+            for final, error in results.items():
+                path, path_size, path_hash = paths[final]
+                if error:
+                    log.warning(f"[Worker {worker_id}] Warning: Pipelined upload of {path} failed, uploading it again: {error}")
+                    follow_ups.append(('upload', path, path_size, path_hash, None))
                     continue
+                log.detail(f"[Worker {worker_id}] Uploaded: {path}")
+                hash_manager.update_local_hash(path, path_hash)
+                metrics.add('files_uploaded')
+                metrics.add('bytes_uploaded', path_size)
+                if unconfirmed is not None:
+                    unconfirmed.append((path, final, path_size))
+                if dedup:
+                    follow_ups.extend(('link', dup, dup_size, path_hash, path) for dup, dup_size in dedup.finish(path_hash, path))
+            metrics.record_task(worker_id, 'upload', rel_path, size, task_start)
+            return
+
+        # Default action: upload
+        local_path = os.path.join(local_dir, rel_path)
+        try:
+            if dry_run:
+                log.detail(f"[Worker {worker_id}] Dry run: Uploading {rel_path}")
+                return
 
-                print(f"[Worker {worker_id}] Uploading: {rel_path}")
-                ensure_dir_exists(sftp, remote_parent, dir_cache)
-                upload_file_with_client(sftp, local_path, remote_path)
-                print(f"[Worker {worker_id}] Done: {rel_path}")
+            chunked = chunk_threshold and os.path.getsize(local_path) >= chunk_threshold
+            # Already-compressed content skips zlib when compression is auto
+            compressed = client_pool.compression != 'auto' or is_compressible(local_path)
+            log.detail(f"[Worker {worker_id}] Uploading{' (chunked)' if chunked else ''}{'' if compressed else ' (uncompressed)'}: {rel_path}")
 
-            except Exception as e:
-                print(f"[Worker {worker_id}] Error processing {rel_path}: {e}")
-                error_list.append(e)
+            def upload():
+                ensure_dir(remote_parent)
+                channel = sftp if compressed else plain_channel()
+                # Hard-linked paths share their content, so never write into
+                # one in place: upload next to it and rename over it
+                target_path = temporary_path(remote_path, worker_id) if atomic_writes else remote_path
+                try:
+                    if chunked:
+                        upload_file_chunked(client_pool, channel, worker_id, local_path, target_path, chunk_parts, compressed)
+                    else:
+                        size = upload_file_with_client(channel, local_path, target_path, buffer_size, confirm=unconfirmed is None)
+                    if target_path != remote_path:
+                        sftp.posix_rename(target_path, remote_path)
+                except Exception:
+                    if target_path != remote_path:
+                        remove_quietly(target_path)
+                    raise
+                if not chunked and unconfirmed is not None:
+                    unconfirmed.append((rel_path, remote_path, size))
+
+            with_retries(upload, rel_path)
+            hash_manager.update_local_hash(rel_path, file_hash)
+            metrics.add('files_uploaded')
+            metrics.add('bytes_uploaded', size)
+            metrics.record_task(worker_id, 'upload', rel_path, size, task_start)
+            log.detail(f"[Worker {worker_id}] Done: {rel_path}")
+            if dedup:
+                # Duplicates found while this was uploading can now be linked to it
+                follow_ups.extend(('link', path, path_size, file_hash, rel_path) for path, path_size in dedup.finish(file_hash, rel_path))
+
+        except Exception as e:
+            log.error(f"[Worker {worker_id}] Error processing {rel_path}: {e}")
+            error_list.append(e)
+            metrics.add('files_failed')
+            if dedup:
+                follow_ups.extend(('upload', path, path_size, file_hash, None) for path, path_size in dedup.finish(file_hash, None))
+
+    # Tasks created by this worker itself, processed before taking new ones
+    follow_ups = collections.deque()
+    try:
+        while True:
+            if follow_ups:
+                process(follow_ups.popleft())
+                continue
+            if controller and controller.should_retire(worker_id):
+                log.detail(f"[Worker {worker_id}] Retired")
+                break
+
+            task = task_queue.get()
+            try:
+                if task is None:
+                    break
+                process(task)
             finally:
                 task_queue.task_done()
+    finally:
+        metrics.worker_stopped(worker_id)
+        if sftp:
+            sftp.close()
+        if plain_sftp:
+            plain_sftp.close()
+
+def checkpoint_task(client_pool, hash_manager, stop_event, interval):
+    """
+    Periodically write the hash file with the work completed so far, so an
+    interrupted run only has to redo the files that hadn't finished yet.
+    """
+    while not stop_event.wait(interval):
+        if not hash_manager.dirty:
+            continue
+        try:
+            hash_manager.save(client_pool.upload_hashes)
+            log.info("Checkpoint: remote hash file updated.")
+        except Exception as e:
+            log.warning(f"Warning: Failed to write checkpoint: {e}")
+            hash_manager.dirty = True
+
+def progress_task(metrics, stop_event, interval, scan_metrics=None):
+    """
+    Periodically log how far the run is: files done out of those found,
+    bytes uploaded, upload rate and, once the scan is complete, the ETA.
+    scan_metrics holds the scan figures when the scan is shared by targets.
+    """
+    scan_metrics = scan_metrics or metrics
+    while not stop_event.wait(interval):
+        counters = dict(metrics.counters)
+        elapsed = time.time() - metrics.start_time
+        done = counters['files_uploaded'] + counters['files_skipped'] + counters['files_moved'] + counters['files_linked'] + counters['files_failed']
+        scanned = scan_metrics.counters['files_scanned']
+        scan_complete = 'scan' in scan_metrics.phases
+
+        if not scan_complete:
+            eta = "scanning"
+        elif done:
+            eta = f"ETA {format_duration(elapsed * (scanned - done) / done)}"
+        else:
+            eta = "ETA unknown"
+        log.info(
+            f"Progress: {done}/{scanned}{'' if scan_complete else '+'} files "
+            f"({counters['files_uploaded']} uploaded, {counters['files_skipped']} unchanged), "
+            f"{format_bytes(counters['bytes_uploaded'])} at {format_bytes(counters['bytes_uploaded'] / elapsed)}/s, {eta}"
+        )
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes}m{seconds:02d}s" if minutes else f"{seconds}s"
+
+def queue_moves(move_candidates, gone_paths, task_queue, threads):
+    """
+    Queue a move for every candidate whose content is tracked under a path
+    that no longer exists locally (gone_paths: remote hash -> paths), each
+    such path being used at most once, and an upload for the rest.
+    Returns the set of paths moved away from.
+    """
+    claimed = set()
+    for rel_path, size, current_hash, compare_hash in move_candidates:
+        source = next((p for p in gone_paths.get(compare_hash, ()) if p not in claimed), None)
+        if source:
+            claimed.add(source)
+            queue_task(task_queue, ('move', rel_path, size, current_hash, source), threads)
+        else:
+            queue_task(task_queue, ('upload', rel_path, size, current_hash, None), threads)
+    return claimed
+
+def queue_task(task_queue, task, threads):
+    """
+    Put a task on a bounded queue, blocking while it is full, without hanging
+    forever if every worker consuming it has died.
+    """
+    while True:
+        try:
+            task_queue.put(task, timeout=1)
+            return
+        except queue.Full:
+            if not any(t.is_alive() for t in threads):
+                raise RuntimeError("All upload workers have stopped")
+
+def scan_stage(local_dir, exclude_matcher, scan_queue, local_files, scan_errors, metrics, on_dir=None):
+    """
+    Walk the local directory and stream (relative path, stat) pairs into the
+    bounded scan queue, recording every path for the delete pass. on_dir is
+    called once with every directory holding files, as soon as it is found.
+    Always finishes with a None sentinel.
+    """
+    seen_dirs = set()
+    try:
+        with metrics.timer('scan'):
+            for rel_path, file_stat in iter_directory(local_dir, exclude_matcher):
+                local_files.add(rel_path)
+                metrics.add('files_scanned')
+                rel_dir = posixpath.dirname(rel_path)
+                if on_dir and rel_dir not in seen_dirs:
+                    seen_dirs.add(rel_dir)
+                    on_dir(rel_dir)
+                scan_queue.put((rel_path, file_stat))
+    except Exception as e:
+        log.error(f"Error scanning local directory: {e}")
+        scan_errors.append(e)
+    finally:
+        scan_queue.put(None)
+
+def directory_task(client_pool, dir_queue, dir_cache, metrics):
+    """
+    Create the remote directories the scan finds ahead of the uploads. Each
+    round takes every directory queued so far and creates the ones missing
+    from the cache with make_remote_dirs, until a None sentinel. Anything
+    left out is created by the workers themselves when they need it.
+    """
+    sftp = None
+    try:
+        done = False
+        while not done:
+            dirs = [dir_queue.get()]
+            while True:
+                try:
+                    dirs.append(dir_queue.get_nowait())
+                except queue.Empty:
+                    break
+            done = None in dirs
+            dirs = [d for d in dirs if d is not None]
+            if not dirs:
+                continue
+            if sftp is None:
+                sftp = client_pool.create_sftp()
+            with metrics.timer('mkdir'):
+                metrics.add('dirs_created', make_remote_dirs(sftp, dirs, dir_cache))
+    except Exception as e:
+        log.warning(f"Warning: Failed to create remote directories ahead of the uploads: {e}")
     finally:
         if sftp:
             sftp.close()
 
+def hash_stage(local_dir, scan_queue, targets, error_list, force_upload, stat_cache, hash_workers):
+    """
+    Hash files coming from the scan queue in a process pool, separate from the
+    upload workers, and hand every result to each target still accepting
+    files, which queues what its server needs. At most a few batches per
+    process are in flight, so a slow upload queue holds back hashing instead
+    of piling up results.
+    Returns a dict of relative path -> hash for every local file.
+    """
+    new_hashes = {}
+    file_stats = {}
+
+    # When a target switches algorithms, also compute the one its remote hash
+    # file was written with so unchanged files are still recognised (in the
+    # same read)
+    live = accepting(targets)
+    algorithms = (live[0].hash_manager.algorithm,)
+    for target in live:
+        if target.hash_manager.remote_algorithm not in algorithms:
+            algorithms += (target.hash_manager.remote_algorithm,)
+
+    def handle_results(future, batch):
+        for rel_path, (digests, error) in zip(batch, future.result()):
+            file_stat = file_stats.pop(rel_path)
+            if error:
+                log.error(f"Error hashing {rel_path}: {error}")
+                error_list.append(error)
+                continue
+
+            current_hash = digests[0] if digests else None
+            new_hashes[rel_path] = current_hash
+            if stat_cache and current_hash and file_stat:
+                stat_cache.update(rel_path, file_stat, current_hash)
+            log.detail(f"Computed hash: {current_hash} for: {rel_path}")
+            dispatch(targets, 'handle_file', rel_path, file_stat.st_size if file_stat else 0, digests, algorithms)
+
+    # Spawn rather than fork: the SSH transports already have threads running
+    executor = ProcessPoolExecutor(max_workers=hash_workers, mp_context=multiprocessing.get_context('spawn'))
+    try:
+        pending = {}
+        batch = []
+        max_pending = hash_workers * 2
+
+        def submit(batch):
+            future = executor.submit(compute_file_hashes, [os.path.join(local_dir, p) for p in batch], algorithms)
+            pending[future] = batch
+            # Apply back-pressure, and hand off finished batches as early as possible
+            done, _ = wait(pending, timeout=0 if len(pending) < max_pending else None, return_when=FIRST_COMPLETED)
+            for future in done:
+                handle_results(future, pending.pop(future))
+
+        for rel_path, file_stat in iter(scan_queue.get, None):
+            # A cached hash is only trusted when it agrees with the remote
+            # manifest of every target; anything else is re-read so the
+            # recorded hash is always computed from the bytes actually
+            # uploaded. Drifted files go through hashing too, to be caught there.
+            if stat_cache and file_stat and not force_upload:
+                cached_hash = stat_cache.get_hash(rel_path, file_stat)
+                if cached_hash and all(t.trusts_cached(rel_path, file_stat.st_size, cached_hash) for t in accepting(targets)):
+                    new_hashes[rel_path] = cached_hash
+                    stat_cache.update(rel_path, file_stat, cached_hash)
+                    log.detail(f"Skipped (cached, no change): {rel_path}")
+                    dispatch(targets, 'skip_file', rel_path, file_stat.st_size, cached_hash)
+                    continue
+
+            file_stats[rel_path] = file_stat
+            batch.append(rel_path)
+            # Don't let a partial batch wait on a slow scan
+            if len(batch) >= HASH_BATCH_SIZE or scan_queue.empty():
+                submit(batch)
+                batch = []
+
+        if batch:
+            submit(batch)
+        for future in as_completed(list(pending)):
+            handle_results(future, pending.pop(future))
+    finally:
+        executor.shutdown(cancel_futures=True)
+    return new_hashes
+
+def accepting(targets):
+    return [target for target in targets if target.accepting]
+
+def dispatch(targets, method, *args):
+    """
+    Call a method on every target still accepting files. A target whose
+    workers have all stopped fails, without holding up the others.
+    """
+    for target in accepting(targets):
+        with log.tagged(target.tag):
+            try:
+                getattr(target, method)(*args)
+            except RuntimeError as e:
+                target.fail(f"Error: {e}")
+
+def run_targets(targets, method, *args):
+    """
+    Run a phase on every target that hasn't failed, each in its own thread
+    so the servers are worked on concurrently. An error fails only its target.
+    """
+    def run(target):
+        try:
+            getattr(target, method)(*args)
+        except DeployError as e:
+            target.fail(f"{e}")
+        except Exception as e:
+            target.fail(f"Unexpected error: {e!r}")
+
+    threads = [target.start_thread(run, target) for target in targets if not target.failed]
+    for thread in threads:
+        thread.join()
+
+def parse_targets(hosts, default_port):
+    """
+    Split the host input into (name, host, port) targets, one per comma or
+    line, each `host`, `host:port` or `[address]:port`.
+    """
+    targets = []
+    for entry in hosts.replace('\n', ',').split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        host, port = entry, default_port
+        if entry.startswith('['):
+            host, _, rest = entry[1:].partition(']')
+            port = rest[1:] if rest.startswith(':') else default_port
+        elif entry.count(':') == 1:
+            host, port = entry.split(':')
+        targets.append((entry, host, port))
+    return targets
+
+class DeployError(Exception):
+    """A target can't be deployed to; the other targets carry on."""
+
+class DeployTarget:
+    """
+    One server the local directory is deployed to. Every target has its own
+    connection pool, hash file, upload queue, workers and metrics, and is
+    fed the files of the scan and hash pass shared by all targets. The
+    phases run in the order prepare, start, handle_file / skip_file for
+    every file, finish_scan, stop and finish.
+    """
+    def __init__(self, name, host, port, options, tagged=False):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.options = options
+        # With several targets, lines logged by a target's threads carry its name
+        self.tag = name if tagged else None
+        self.metrics = Metrics()
+        # Where the shared scan is counted, for the progress lines
+        self.scan_metrics = self.metrics
+        self.client = None
+        self.failed = False
+        self.accepting = False
+        self.error_list = []
+        self.threads = []
+        self.controller = None
+        self.dir_stage = None
+        self.checkpointer = None
+        self.checkpoint_stop = threading.Event()
+        self.progress_stop = threading.Event()
+
+    def start_thread(self, function, *args, daemon=False):
+        def run():
+            with log.tagged(self.tag):
+                function(*args)
+
+        thread = threading.Thread(target=run, daemon=daemon)
+        thread.start()
+        return thread
+
+    def fail(self, message):
+        log.error(message)
+        self.failed = True
+        self.accepting = False
+
+    def queue(self, task):
+        queue_task(self.task_queue, task, self.threads)
+
+    def prepare(self):
+        """Connect, find the baseline hash file and load it."""
+        o = self.options
+        try:
+            with self.metrics.timer('connect'):
+                self.client = SFTPConnectionPool(connections=o.connections, host=self.host, port=self.port, **o.connect_kwargs)
+        except Exception as e:
+            raise DeployError(f"Failed to connect: {e}")
+        log.info(f"Negotiated: {self.client.negotiated()}")
+
+        # In release mode everything goes into a new release directory, and
+        # the hash file of the release `current` points to is the baseline
+        self.deploy_dir = o.remote_dir
+        previous_release = None
+        if o.release_mode:
+            self.deploy_dir = release_path(o.remote_dir, o.release_id)
+            sftp = self.client.create_sftp()
+            try:
+                previous_release = current_release(sftp, o.remote_dir)
+            finally:
+                sftp.close()
+            if previous_release == o.release_id:
+                raise DeployError(f"Error: Release '{o.release_id}' is the active release and can't be deployed again.")
+            log.info(f"Previous release: {previous_release or 'none'}")
+
+        # Load Remote Hashes
+        hash_file_remote_path = os.path.join(self.deploy_dir, '.sftp_upload_action_hashes').replace('\\', '/')
+        baseline_hash_file_path = hash_file_remote_path
+        if o.release_mode and previous_release:
+            baseline_hash_file_path = os.path.join(release_path(o.remote_dir, previous_release), '.sftp_upload_action_hashes')
+        self.hash_manager = HashManager(baseline_hash_file_path, o.hash_algorithm, o.hash_file_compression, o.hash_file_shards)
+        # Shards of a sharded hash file are fetched lazily, on first lookup
+        self.hash_manager.shard_loader = self.client.download_hashes
+
+        self.reuse_prefix = None
+        self.remote_sizes = None
+        self.known_dirs = set()
+        if not o.force_upload and (previous_release or not o.release_mode):
+            log.info("Fetching remote hash file...")
+            with self.metrics.timer('manifest_download'):
+                remote_hashes = self.client.download_hashes(baseline_hash_file_path)
+            if remote_hashes:
+                self.hash_manager.load(remote_hashes)
+                log.info("Remote hash file loaded.")
+                if not o.release_mode:
+                    # The directories of tracked files exist, no need to check them
+                    self.known_dirs = {self.deploy_dir} | {posixpath.normpath(posixpath.join(self.deploy_dir, d)) for d in self.hash_manager.remote_dirs()}
+                if previous_release:
+                    # Unchanged files are linked from the previous release
+                    self.reuse_prefix = f"../{previous_release}/"
+                if o.verify_remote:
+                    self.remote_sizes = verify_remote_tree(self.client, baseline_hash_file_path, o.concurrency, self.metrics)
+            else:
+                log.info("No remote hash file found. Full upload.")
+        elif not o.release_mode:
+            # A forced upload ignores the hashes, but must still know about hard links
+            with self.metrics.timer('manifest_download'):
+                self.hash_manager.hardlinks = HashManager.links_recorded(self.client.download_hashes(baseline_hash_file_path))
+        if baseline_hash_file_path != hash_file_remote_path:
+            self.hash_manager.relocate(hash_file_remote_path)
+        if self.hash_manager.remote_algorithm != self.hash_manager.algorithm:
+            log.info(f"Migrating hash file from {self.hash_manager.remote_algorithm} to {self.hash_manager.algorithm}.")
+
+    def start_worker(self, worker_id):
+        o = self.options
+        self.threads.append(self.start_thread(
+            worker_task, worker_id, self.client, self.task_queue, self.error_list, o.local_dir, self.deploy_dir, o.dry_run, self.hash_manager,
+            o.chunk_threshold, o.chunk_parts, o.buffer_size, self.unconfirmed, o.retries, o.retry_delay, self.metrics, self.link_tracker, self.controller, self.dir_cache, self.atomic_writes, self.moved,
+        ))
+
+    def start(self):
+        """Start the upload workers, so they pick up changed files as soon as they are hashed."""
+        o = self.options
+        log.info(f"Starting processing with {o.concurrency} workers...")
+        self.start_time = time.time()
+        self.task_queue = TaskScheduler(maxsize=UPLOAD_QUEUE_SIZE, policy=o.schedule_policy)
+        # Uploads awaiting the batched size check when confirmUpload is off
+        self.unconfirmed = None if o.confirm_upload else []
+        self.dedup = DuplicateTracker() if o.deduplicate else None
+        # Workers also track hard link support for release reuse
+        self.link_tracker = self.dedup or (DuplicateTracker() if o.release_mode else None)
+        if self.link_tracker:
+            # Only deduplication replaces existing paths, which needs the rename
+            sftp = self.client.create_sftp()
+            try:
+                supported = links_supported(sftp, self.deploy_dir, rename=bool(self.dedup))
+            finally:
+                sftp.close()
+            if not supported:
+                log.warning("Warning: The server doesn't support hard links (or posix-rename@openssh.com), files are uploaded instead of linked.")
+                self.link_tracker.hardlinks = False
+        if self.dedup and self.dedup.hardlinks and not o.release_mode:
+            # Links stay on the server after the option is turned off, so the
+            # hash file remembers them
+            self.hash_manager.hardlinks = True
+        # Paths that may be hard links are replaced by renaming, never written
+        # in place; a new release directory has no such paths
+        self.atomic_writes = bool(self.dedup and self.dedup.hardlinks) or self.hash_manager.hardlinks
+
+        self.batcher = None
+        if o.tar_threshold:
+            if self.client.exec_available():
+                self.batcher = TarBatcher(o.tar_threshold, o.tar_batch_files, TAR_BATCH_BYTES)
+                log.info(f"Tar Batches: files < {o.tar_threshold} bytes, up to {o.tar_batch_files} per batch")
+            else:
+                log.warning("Warning: The server doesn't allow running tar over exec, small files are uploaded one by one.")
+        # Tar batches take the small files when both are enabled
+        self.batch_action = 'tar'
+        if not self.batcher and o.engine == 'pipelined':
+            threshold = min(PIPELINED_FILE_BYTES, o.chunk_threshold or PIPELINED_FILE_BYTES)
+            self.batcher = TarBatcher(threshold, PIPELINED_BATCH_FILES, TAR_BATCH_BYTES)
+            self.batch_action = 'pipelined'
+
+        # Directories are created ahead of the uploads, as the scan finds them
+        self.dir_cache = DirectoryCache(self.known_dirs)
+        self.dir_queue = queue.Queue()
+        if not o.dry_run:
+            self.dir_stage = self.start_thread(directory_task, self.client, self.dir_queue, self.dir_cache, self.metrics, daemon=True)
+
+        # Removed together in the delete phase, once the workers are done
+        self.files_to_delete = []
+        # Sources of the moves that succeeded, filled by the workers
+        self.moved = set()
+        # Moves replace a delete and an upload, so they need deletes enabled
+        self.move_index = None
+        self.move_candidates = []
+        if o.remove_extra_files and o.detect_moves and not o.force_upload:
+            self.move_index = self.hash_manager.paths_by_hash()
+
+        if o.auto_concurrency:
+            self.controller = ConcurrencyController(self.start_worker, self.metrics, self.task_queue)
+            self.controller.start()
+        else:
+            for i in range(o.concurrency):
+                self.start_worker(i + 1)
+
+        # Periodically persist completed work. Skipped while switching hash
+        # algorithms, as files not reached yet still carry old-algorithm hashes,
+        # and for releases, which are never resumed (a new one is built instead).
+        self.resumable = not o.dry_run and not o.release_mode and self.hash_manager.remote_algorithm == self.hash_manager.algorithm
+        if self.resumable and o.checkpoint_interval > 0:
+            self.checkpointer = self.start_thread(checkpoint_task, self.client, self.hash_manager, self.checkpoint_stop, o.checkpoint_interval, daemon=True)
+
+        self.start_thread(progress_task, self.metrics, self.progress_stop, PROGRESS_INTERVAL, self.scan_metrics, daemon=True)
+        self.accepting = True
+
+    def trusts_cached(self, rel_path, size, cached_hash):
+        """Whether a hash from the stat cache lets this target skip the file unread."""
+        verified = self.remote_sizes is None or self.remote_sizes.get(rel_path) == size
+        return verified and cached_hash == self.hash_manager.get_remote_hash(rel_path)
+
+    def skip_file(self, rel_path, size, file_hash):
+        # An unchanged file is on the server already, at its own path or in
+        # the previous release
+        self.metrics.add('files_skipped')
+        self.metrics.add('bytes_skipped', size)
+        source = f"{self.reuse_prefix}{rel_path}" if self.reuse_prefix else rel_path
+        if self.dedup and file_hash:
+            self.dedup.exists(file_hash, source)
+        if self.reuse_prefix:
+            self.queue(('reuse', rel_path, size, file_hash, source))
+
+    def handle_file(self, rel_path, size, digests, algorithms):
+        """
+        Queue a hashed file if its hash differs from the remote hash file.
+        With a move_index (remote hash -> tracked paths), changed files whose
+        content the server already has under another path are kept as move
+        candidates instead, to be matched after the scan.
+        With a DuplicateTracker, only the first changed file of each hash is
+        queued for upload and the others are linked to it.
+        With a reuse_prefix (the previous release, relative to the remote dir),
+        unchanged files are queued to be hard-linked from there instead of skipped.
+        With a TarBatcher, small files are queued in batches to be sent as tar.
+        With remote_sizes (relative path -> size of the files verified on the
+        server), unchanged files that are missing there or differ in size are
+        queued again.
+        """
+        current_hash = digests[0] if digests else None
+        compare_hash = digests[algorithms.index(self.hash_manager.remote_algorithm)] if digests else None
+
+        unchanged = not self.options.force_upload and self.hash_manager.get_remote_hash(rel_path) == compare_hash
+        if unchanged and self.remote_sizes is not None and self.remote_sizes.get(rel_path) != size:
+            log.info(f"Drift: {rel_path} was changed or removed on the server, uploading it again")
+            self.metrics.add('files_drifted')
+            unchanged = False
+        if unchanged:
+            log.detail(f"Skipped (no change): {rel_path}")
+            self.skip_file(rel_path, size, current_hash)
+            return
+
+        if self.move_index and compare_hash in self.move_index:
+            self.move_candidates.append((rel_path, size, current_hash, compare_hash))
+            return
+        action, source = self.dedup.add(current_hash, rel_path, size) if self.dedup and current_hash else ('upload', None)
+        if action == 'upload' and self.batcher and self.batcher.accepts(size):
+            self.queue_batch(self.batcher.add(rel_path, size, current_hash))
+        elif action:
+            self.queue((action, rel_path, size, current_hash, source))
+
+    def need_dir(self, rel_dir):
+        """Queue a directory of the scan to be created, unless known to exist."""
+        remote_dir = posixpath.normpath(posixpath.join(self.deploy_dir, rel_dir))
+        if self.dir_stage and remote_dir not in self.dir_cache:
+            self.dir_queue.put(remote_dir)
+
+    def queue_batch(self, batch):
+        if not batch:
+            return
+        if len(batch) == 1:
+            rel_path, size, file_hash = batch[0]
+            self.queue(('upload', rel_path, size, file_hash, None))
+            return
+        total_size = sum(size for _, size, _ in batch)
+        self.queue((self.batch_action, f"{len(batch)} files ({self.batch_action})", total_size, None, batch))
+
+    def finish_scan(self, local_files, scan_errors):
+        """Queue the work that needs the complete scan: the last tar batch and moves, and list the deletes."""
+        if self.batcher:
+            self.queue_batch(self.batcher.flush())
+
+        moved_from = set()
+        if self.move_candidates:
+            # Only a complete scan tells which tracked paths are really gone
+            gone_paths = {} if scan_errors else {
+                file_hash: [p for p in paths if p not in local_files]
+                for file_hash, paths in self.move_index.items()
+            }
+            moved_from = queue_moves(self.move_candidates, gone_paths, self.task_queue, self.threads)
+            log.info(f"Detected {len(moved_from)} moved files.")
+
+        # Deletes, if enabled, are never based on an incomplete scan
+        if self.options.remove_extra_files and not scan_errors:
+            # Files in remote hash but not in local files. Move sources are
+            # listed too: the file is uploaded when its move fails, so only a
+            # move that succeeded keeps its source out of the delete phase
+            remote_tracked_files = self.hash_manager.remote_paths()
+            self.files_to_delete = sorted(remote_tracked_files - local_files)
+            extra_files = len(set(self.files_to_delete) - moved_from)
+
+            if extra_files:
+                log.info(f"Found {extra_files} files to delete (from hash records).")
+            else:
+                log.info("No files to delete based on hash records.")
+
+    def stop(self):
+        """Let the workers drain the queue, then stop them and the helper threads."""
+        self.accepting = False
+        # No workers may start after the sentinels are queued
+        if self.controller:
+            self.controller.stop()
+        if self.dir_stage:
+            self.dir_queue.put(None)
+        # One sentinel per worker so they all stop once the queue drains
+        try:
+            for _ in self.threads:
+                self.queue(None)
+        except RuntimeError:
+            pass
+
+        for t in self.threads:
+            t.join()
+        if self.dir_stage:
+            self.dir_stage.join()
+
+        self.checkpoint_stop.set()
+        if self.checkpointer:
+            self.checkpointer.join()
+        self.progress_stop.set()
+
+    def delete_files(self):
+        """
+        Remove the files that are gone locally, pipelining the remove
+        requests over all channels and retrying the ones that failed, then
+        the directories left empty by the deletes and moves, deepest first.
+        """
+        o = self.options
+        if o.dry_run:
+            for rel_path in self.files_to_delete:
+                log.detail(f"Dry run: Would remove {rel_path}")
+            return
+
+        remote_paths = {posixpath.normpath(posixpath.join(o.remote_dir, rel_path)): rel_path for rel_path in self.files_to_delete}
+        emptied = set()
+
+        def add_parents(rel_path):
+            parent = posixpath.dirname(rel_path)
+            while parent and parent not in emptied:
+                emptied.add(parent)
+                parent = posixpath.dirname(parent)
+
+        if remote_paths:
+            log.info(f"Deleting {len(remote_paths)} files...")
+        with self.metrics.timer('delete'):
+            pending = list(remote_paths)
+            for attempt in range(o.retries + 1):
+                try:
+                    results = remove_remote_files(self.client, pending, o.concurrency)
+                except Exception as e:
+                    results = dict.fromkeys(pending, e)
+                for remote_path, error in results.items():
+                    if error:
+                        continue
+                    rel_path = remote_paths[remote_path]
+                    log.detail(f"Removed: {rel_path}")
+                    self.hash_manager.remove_hash(rel_path)
+                    self.metrics.add('files_deleted')
+                    add_parents(rel_path)
+                pending = [remote_path for remote_path, error in results.items() if error]
+                if not pending or attempt >= o.retries:
+                    break
+                delay = o.retry_delay * (2 ** attempt)
+                log.warning(f"Attempt {attempt + 1} failed for {len(pending)} deletes. Retrying in {delay:.1f}s...")
+                time.sleep(delay)
+            for remote_path in pending:
+                # Left on the server, as before: a stale file doesn't fail the deploy
+                log.warning(f"Warning: Failed to remove {remote_paths[remote_path]}: {results[remote_path]}")
+
+            for rel_path in self.moved:
+                add_parents(rel_path)
+            if emptied:
+                try:
+                    removed = remove_empty_dirs(self.client, [posixpath.normpath(posixpath.join(o.remote_dir, d)) for d in emptied], o.concurrency)
+                except Exception as e:
+                    # The files are gone; leftover directories are harmless
+                    log.warning(f"Warning: Failed to remove empty directories: {e}")
+                else:
+                    if removed:
+                        log.info(f"Removed {len(removed)} empty directories.")
+
+    def finish(self, new_hashes):
+        """Delete extra files and check batched uploads, then save the hash file and activate the release."""
+        o = self.options
+        # Now that the workers are done, sources of failed moves are known
+        self.files_to_delete = [rel_path for rel_path in self.files_to_delete if rel_path not in self.moved]
+        if self.files_to_delete or self.moved:
+            self.delete_files()
+        if self.unconfirmed:
+            log.info(f"Verifying {len(self.unconfirmed)} uploaded files...")
+            uploads = {remote_path: (rel_path, size) for rel_path, remote_path, size in self.unconfirmed}
+            sizes = [(remote_path, size) for _, remote_path, size in self.unconfirmed]
+            # The batched check is the tail of the upload phase
+            with self.metrics.timer('upload'):
+                problems = verify_remote_sizes(self.client, sizes, o.concurrency)
+            for remote_path, problem in problems:
+                log.error(f"Error verifying {remote_path}: {problem}")
+                self.error_list.append(IOError(problem))
+                rel_path, size = uploads[remote_path]
+                self.metrics.add('files_failed')
+                self.metrics.add('files_uploaded', -1)
+                self.metrics.add('bytes_uploaded', -size)
+                # Make sure the next run uploads it again
+                self.hash_manager.remove_hash(rel_path)
+
+        if self.error_list:
+            self.fail(f"Upload/Hash check completed with {len(self.error_list)} errors.")
+            # Keep the work that did complete, so the next run resumes from here
+            if self.resumable:
+                log.info("Saving progress to remote hash file...")
+                with self.metrics.timer('manifest_upload'):
+                    self.hash_manager.save(self.client.upload_hashes)
+            return
+
+        duration = time.time() - self.start_time
+        counters = self.metrics.counters
+        log.result(
+            f"Processing completed in {duration:.2f}s: {counters['files_uploaded']} uploaded "
+            f"({format_bytes(counters['bytes_uploaded'])}), {counters['files_skipped']} unchanged, "
+            f"{counters['files_moved']} moved, {counters['files_linked']} linked, {counters['files_deleted']} deleted."
+        )
+
+        # Update Remote Hash File
+        log.info("Updating remote hash file...")
+        # We replace the tracked hashes with ALL current local files (sync state),
+        # which also drops files that no longer exist locally
+        self.hash_manager.set_hashes(new_hashes)
+
+        if not o.dry_run:
+            with self.metrics.timer('manifest_upload'):
+                self.hash_manager.save(self.client.upload_hashes)
+        else:
+            log.info("Dry run: Would update remote hash file.")
+
+        # Switch to the new release, only once it is complete
+        if o.release_mode and not o.dry_run:
+            with self.metrics.timer('release'):
+                sftp = self.client.create_sftp()
+                try:
+                    activate_release(sftp, o.remote_dir, o.release_id)
+                    log.info(f"Activated release {o.release_id}.")
+                    removed = prune_releases(sftp, o.remote_dir, o.keep_releases, o.release_id)
+                    if removed:
+                        log.info(f"Removed old releases: {', '.join(removed)}")
+                except IOError as e:
+                    raise DeployError(f"Failed to activate release {o.release_id}: {e}")
+                finally:
+                    sftp.close()
+        elif o.release_mode:
+            log.info(f"Dry run: Would activate release {o.release_id}.")
+        log.info("Done.")
+
+    def close(self):
+        if self.client:
+            self.client.close()
+
+def verify_remote_tree(client_pool, hash_file_path, workers, metrics):
+    """
+    List the directory holding the hash file and return relative path ->
+    size of the files that still match the last deploy. Files modified
+    after the hash file was written are left out, like missing ones, so
+    they are uploaded again. Returns None if the listing fails.
+    """
+    log.info("Verifying remote files...")
+    try:
+        with metrics.timer('verify'):
+            listing = list_remote_tree(client_pool, posixpath.dirname(hash_file_path), workers)
+    except Exception as e:
+        log.warning(f"Warning: Failed to list remote files, trusting the hash file: {e}")
+        return None
+    written = listing.get(posixpath.basename(hash_file_path), (0, None))[1]
+    if written is None:
+        # No date for the last deploy: only existence and size count
+        written = float('inf')
+    return {rel_path: size for rel_path, (size, mtime) in listing.items() if mtime <= written}
+
+def publish_metrics(metrics, report_file, targets=None):
+    """
+    Print the phase timings and write the run report to reportFile, the
+    GitHub Actions step outputs and the job summary, where available.
+    With several targets, metrics holds the shared scan and hash stages and
+    the report combines it with the report of every target.
+    """
+    metrics.finish()
+    report = metrics.report()
+    log.info("Phase timings: " + ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in report['phases'].items()))
+    if targets:
+        target_reports = {}
+        for target in targets:
+            target.metrics.finish()
+            target_reports[target.name] = target.metrics.report()
+            target_reports[target.name]['failed'] = target.failed
+            log.info(f"Phase timings ({target.name}): " + ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in target_reports[target.name]['phases'].items()))
+        report = combine_reports(report, target_reports)
+
+    outputs = [
+        (report_file, metrics.write_report),
+        (os.environ.get('GITHUB_OUTPUT'), metrics.write_outputs),
+        (os.environ.get('GITHUB_STEP_SUMMARY'), metrics.write_summary),
+    ]
+    for path, write in outputs:
+        if not path:
+            continue
+        try:
+            write(path, report)
+        except OSError as e:
+            log.warning(f"Warning: Failed to write metrics to {path}: {e}")
+
 def main():
     # Load inputs from environment variables
     host = os.environ.get('INPUT_HOST')
@@ -114,132 +1084,248 @@ def main():
     force_upload = os.environ.get('INPUT_FORCEUPLOAD', 'false').lower() == 'true'
     exclude_str = os.environ.get('INPUT_EXCLUDE', '')
     remove_extra_files = os.environ.get('INPUT_REMOVEEXTRAFILESONSERVER', 'false').lower() == 'true'
-    concurrency = int(os.environ.get('INPUT_CONCURRENCY', '4'))
+    detect_moves = os.environ.get('INPUT_DETECTMOVES', 'true').lower() != 'false'
+    deduplicate = os.environ.get('INPUT_DEDUPLICATE', 'false').lower() == 'true'
+    release_mode = os.environ.get('INPUT_RELEASEMODE', 'false').lower() == 'true'
+    release_id = os.environ.get('INPUT_RELEASEID', '') or time.strftime('%Y%m%d%H%M%S', time.gmtime())
+    keep_releases = max(1, int(os.environ.get('INPUT_KEEPRELEASES', '') or '5'))
+    tar_threshold = parse_size(os.environ.get('INPUT_TARTHRESHOLD', '') or '0')
+    tar_batch_files = int(os.environ.get('INPUT_TARBATCHFILES', '') or '1000')
+    engine = (os.environ.get('INPUT_ENGINE', '') or 'threads').lower()
+    # A new release only ever contains the local files, there is nothing to remove
+    remove_extra_files = remove_extra_files and not release_mode
+    concurrency_input = (os.environ.get('INPUT_CONCURRENCY', '') or '4').lower()
+    connections = int(os.environ.get('INPUT_CONNECTIONS', '1') or '1')
+    channels_per_connection = os.environ.get('INPUT_CHANNELSPERCONNECTION', '')
+    hash_cache_path = os.environ.get('INPUT_HASHCACHE', '')
+    hash_workers = int(os.environ.get('INPUT_HASHWORKERS', '') or os.cpu_count() or 1)
+    hash_algorithm = (os.environ.get('INPUT_HASHALGORITHM', '') or 'md5').lower()
+    hash_file_compression = (os.environ.get('INPUT_HASHFILECOMPRESSION', '') or 'gzip').lower()
+    hash_file_shards = os.environ.get('INPUT_HASHFILESHARDS', 'false').lower() == 'true'
+    chunk_threshold = parse_size(os.environ.get('INPUT_CHUNKEDUPLOADTHRESHOLD', '') or '0')
+    chunk_parts = int(os.environ.get('INPUT_CHUNKEDUPLOADPARTS', '') or '4')
+    schedule_policy = (os.environ.get('INPUT_SCHEDULE', '') or 'largest-first').lower()
+    window_size = parse_size(os.environ.get('INPUT_WINDOWSIZE', '') or '0')
+    max_packet_size = parse_size(os.environ.get('INPUT_MAXPACKETSIZE', '') or '0')
+    ciphers = [c.strip() for c in os.environ.get('INPUT_CIPHERS', '').split(',') if c.strip()]
+    macs = [m.strip() for m in os.environ.get('INPUT_MACS', '').split(',') if m.strip()]
+    kex = [k.strip() for k in os.environ.get('INPUT_KEXALGORITHMS', '').split(',') if k.strip()]
+    compression = (os.environ.get('INPUT_COMPRESSION', '') or 'on').lower()
+    buffer_size = parse_size(os.environ.get('INPUT_BUFFERSIZE', '') or '0') or CHUNK_READ_SIZE
+    confirm_upload = os.environ.get('INPUT_CONFIRMUPLOAD', 'true').lower() != 'false'
+    retries = int(os.environ.get('INPUT_RETRIES', '') or '3')
+    retry_delay = float(os.environ.get('INPUT_RETRYDELAY', '') or '1')
+    checkpoint_interval = float(os.environ.get('INPUT_CHECKPOINTINTERVAL', '') or '30')
+    verify_remote = os.environ.get('INPUT_VERIFYREMOTE', 'false').lower() == 'true'
+    report_file = os.environ.get('INPUT_REPORTFILE', '')
+    log_level = (os.environ.get('INPUT_LOGLEVEL', '') or 'summary').lower()
 
     if not host or not username or not local_dir or not remote_dir:
-        print("Error: Missing required inputs (host, username, localDir, remoteDir)")
+        log.error("Error: Missing required inputs (host, username, localDir, remoteDir)")
+        sys.exit(1)
+
+    try:
+        new_hasher(hash_algorithm)
+    except (ValueError, ImportError) as e:
+        log.error(f"Error: Hash algorithm '{hash_algorithm}' is not available: {e}")
+        sys.exit(1)
+
+    if hash_file_compression not in MANIFEST_COMPRESSIONS:
+        log.error(f"Error: Unsupported hash file compression '{hash_file_compression}'. Supported: {', '.join(MANIFEST_COMPRESSIONS)}.")
+        sys.exit(1)
+    try:
+        compress_manifest('', hash_file_compression)
+    except ImportError as e:
+        log.error(f"Error: Hash file compression '{hash_file_compression}' is not available: {e}")
+        sys.exit(1)
+
+    if release_mode and ('/' in release_id or release_id in ('.', '..')):
+        log.error(f"Error: Invalid release id '{release_id}'.")
+        sys.exit(1)
+
+    if log_level not in LOG_LEVELS:
+        log.error(f"Error: Unknown log level '{log_level}'. Supported: {', '.join(LOG_LEVELS)}.")
+        sys.exit(1)
+    log.set_level(log_level)
+
+    if compression not in COMPRESSION_POLICIES:
+        log.error(f"Error: Unknown compression '{compression}'. Supported: {', '.join(COMPRESSION_POLICIES)}.")
+        sys.exit(1)
+
+    algorithms = supported_algorithms()
+    for kind, names in (('ciphers', [] if ciphers == ['auto'] else ciphers), ('macs', macs), ('kex', kex)):
+        unknown = [name for name in names if name not in algorithms[kind]]
+        if unknown:
+            log.error(f"Error: Unsupported {kind}: {', '.join(unknown)}. Supported: {', '.join(algorithms[kind])}.")
+            sys.exit(1)
+
+    if engine not in ENGINES:
+        log.error(f"Error: Unknown engine '{engine}'. Supported: {', '.join(ENGINES)}.")
+        sys.exit(1)
+
+    if schedule_policy not in SCHEDULE_POLICIES:
+        log.error(f"Error: Unknown schedule '{schedule_policy}'. Supported: {', '.join(SCHEDULE_POLICIES)}.")
         sys.exit(1)
 
     # Prepare exclude patterns
     exclude_patterns = [p.strip() for p in exclude_str.split(',') if p.strip()]
-    # Always exclude the hash file itself from being uploaded as a regular file
+    ignore_file_path = os.path.join(local_dir, IGNORE_FILE)
+    ignore_patterns = read_ignore_file(ignore_file_path) if os.path.isfile(ignore_file_path) else []
+    exclude_patterns.extend(ignore_patterns)
+    # Always exclude the hash file itself from being uploaded as a regular file;
+    # listed last so no negation can bring it back
     exclude_patterns.append('.sftp_upload_action_hashes')
+    exclude_patterns.append('.sftp_upload_action_hashes.d/*')
 
-    print(f"Starting SFTP Upload to {host}:{port}...")
-    print(f"Local Dir: {local_dir}")
-    print(f"Remote Dir: {remote_dir}")
-    print(f"Concurrency: {concurrency}")
+    stat_cache = None
+    if hash_cache_path:
+        stat_cache = StatCache(hash_cache_path, hash_algorithm)
+        stat_cache.load()
+        # Never upload the cache itself if it lives inside localDir
+        cache_rel_path = os.path.relpath(os.path.abspath(hash_cache_path), os.path.abspath(local_dir))
+        if not cache_rel_path.startswith('..'):
+            exclude_patterns.append(cache_rel_path.replace(os.sep, '/'))
+    # Compiled once; the scan checks every path against it
+    exclude_matcher = ExcludeMatcher(exclude_patterns)
 
-    client = None
-    # 1. Connect
-    try:
-        client = SFTPClientWrapper(
-            host=host, 
-            port=port, 
-            username=username, 
-            password=password, 
-            key_data=private_key, 
-            passphrase=passphrase
-        )
-    except Exception as e:
-        print(f"Failed to connect: {e}")
+    # With `auto` the worker count is tuned while uploading, from a small start
+    auto_concurrency = concurrency_input == 'auto' and not channels_per_connection
+    if concurrency_input == 'auto':
+        concurrency = AUTO_INITIAL_WORKERS
+    else:
+        try:
+            concurrency = int(concurrency_input)
+        except ValueError:
+            log.error(f"Error: Invalid concurrency '{concurrency_input}'. Use a number or 'auto'.")
+            sys.exit(1)
+
+    # Workers are spread across the connections; never open more than we can use
+    if channels_per_connection:
+        concurrency = connections * int(channels_per_connection)
+    connections = max(1, min(connections, AUTO_MAX_WORKERS if auto_concurrency else concurrency))
+
+    hosts = parse_targets(host, port)
+    if len({name for name, _, _ in hosts}) != len(hosts):
+        log.error("Error: The same host is listed more than once.")
+        sys.exit(1)
+
+    if not os.path.isdir(local_dir):
+        log.error(f"Local directory not found: {os.path.abspath(local_dir)}")
         sys.exit(1)
 
+    log.info(f"Starting SFTP Upload to {', '.join(f'{h}:{p}' for _, h, p in hosts)}...")
+    log.info(f"Local Dir: {local_dir}")
+    log.info(f"Remote Dir: {remote_dir}")
+    if auto_concurrency:
+        log.info(f"Concurrency: auto, {concurrency} to {AUTO_MAX_WORKERS} workers ({connections} connection(s)), {hash_workers} hash worker(s)")
+    else:
+        log.info(f"Concurrency: {concurrency} ({connections} connection(s)), {hash_workers} hash worker(s)")
+    log.info(f"Hash Algorithm: {hash_algorithm}")
+    log.info(f"Schedule: {schedule_policy}")
+    if not confirm_upload:
+        log.info("Upload Confirmation: batched size check after all uploads")
+    if chunk_threshold:
+        log.info(f"Chunked Uploads: files >= {chunk_threshold} bytes in {chunk_parts} parts")
+    if deduplicate:
+        log.info("Deduplication: identical files are uploaded once and hard-linked")
+    if release_mode:
+        log.info(f"Release: {release_path(remote_dir, release_id)} (keeping {keep_releases} releases)")
+    if stat_cache:
+        log.info(f"Hash Cache: {hash_cache_path} ({len(stat_cache.entries)} entries)")
+    if engine != 'threads':
+        log.info(f"Engine: {engine} (files < {format_bytes(PIPELINED_FILE_BYTES)} in batches of {PIPELINED_BATCH_FILES}, up to {ENGINE_WINDOW} requests in flight per worker)")
+    if compression != 'on':
+        log.info(f"Compression: {compression}")
+    if ignore_patterns:
+        log.info(f"Ignore File: {IGNORE_FILE} ({len(ignore_patterns)} patterns)")
+
+    if ciphers == ['auto']:
+        # Offer the ciphers fastest on this machine first; the server picks
+        # the first one of the list it supports
+        rates = benchmark_ciphers(algorithms['ciphers'], macs[0] if macs else 'hmac-sha2-256')
+        ciphers = [name for name, _ in rates]
+        log.info(f"Cipher Benchmark: {', '.join(f'{name} {format_bytes(rate)}/s' for name, rate in rates[:3])}")
+
+    # Settings shared by every target
+    options = types.SimpleNamespace(
+        local_dir=local_dir, remote_dir=remote_dir, dry_run=dry_run, force_upload=force_upload,
+        remove_extra_files=remove_extra_files, detect_moves=detect_moves, deduplicate=deduplicate,
+        release_mode=release_mode, release_id=release_id, keep_releases=keep_releases,
+        tar_threshold=tar_threshold, tar_batch_files=tar_batch_files, engine=engine,
+        concurrency=concurrency, auto_concurrency=auto_concurrency, connections=connections,
+        hash_algorithm=hash_algorithm, hash_file_compression=hash_file_compression, hash_file_shards=hash_file_shards,
+        chunk_threshold=chunk_threshold, chunk_parts=chunk_parts, schedule_policy=schedule_policy,
+        buffer_size=buffer_size, confirm_upload=confirm_upload, retries=retries, retry_delay=retry_delay,
+        checkpoint_interval=checkpoint_interval, verify_remote=verify_remote,
+        connect_kwargs=dict(
+            username=username,
+            password=password,
+            key_data=private_key,
+            passphrase=passphrase,
+            window_size=window_size,
+            max_packet_size=max_packet_size,
+            ciphers=ciphers or None,
+            macs=macs or None,
+            kex=kex or None,
+            compression=compression,
+        ),
+    )
+    targets = [DeployTarget(name, target_host, target_port, options, tagged=len(hosts) > 1) for name, target_host, target_port in hosts]
+    # The scan and hash pass is shared; with one target it is counted in its metrics
+    metrics = targets[0].metrics if len(targets) == 1 else Metrics()
+    for target in targets:
+        target.scan_metrics = metrics
+
+    # Buffer output from here on, so workers don't contend on stdout
+    log.start()
     try:
-        # 2. Load Remote Hashes
-        hash_file_remote_path = os.path.join(remote_dir, '.sftp_upload_action_hashes').replace('\\', '/')
-        hash_manager = HashManager(hash_file_remote_path)
-        
-        if not force_upload:
-            print("Fetching remote hash file...")
-            remote_hashes_json = client.download_hashes(hash_file_remote_path)
-            if remote_hashes_json:
-                hash_manager.load(remote_hashes_json)
-                print("Remote hash file loaded.")
-            else:
-                print("No remote hash file found. Full upload.")
+        # 1. Connect and load the remote hashes of every target
+        run_targets(targets, 'prepare')
+        run_targets(targets, 'start')
 
-        # 3. Scan Local Files
-        print("Scanning local directory...")
-        try:
-            local_files = scan_directory(local_dir, exclude_patterns)
-        except FileNotFoundError as e:
-            print(e)
-            sys.exit(1)
-        
-        print(f"Found {len(local_files)} files.")
-
-        # 4. Parallel Process (Hash & Upload)
-        print(f"Starting processing with {concurrency} workers...")
-        start_time = time.time()
-
-        task_queue = queue.Queue()
-        # Add upload tasks
-        for rel_path in local_files:
-            task_queue.put(('upload', rel_path))
-        
-        # Add delete tasks if enabled
-        if remove_extra_files:
-            # Files in remote hash but not in local files
-            remote_tracked_files = set(hash_manager.hashes.keys())
-            local_files_set = set(local_files)
-            files_to_delete = list(remote_tracked_files - local_files_set)
-            
-            if files_to_delete:
-                print(f"Found {len(files_to_delete)} files to delete (from hash records).")
-                for rel_path in files_to_delete:
-                    task_queue.put(('delete', rel_path))
-            else:
-                 print("No files to delete based on hash records.")
-        
-        result_queue = queue.Queue()
-        threads = []
+        # 2. Scan, Hash & Upload
+        # The stages are connected by bounded queues, so uploads start as soon
+        # as the first changed file is found and memory stays flat.
+        scan_queue = queue.Queue(maxsize=SCAN_QUEUE_SIZE)
+        local_files = set()
+        new_hashes = {}
         error_list = []
-        
-        for i in range(concurrency):
-            t = threading.Thread(target=worker_task, args=(i+1, client, task_queue, result_queue, error_list, local_dir, remote_dir, dry_run, hash_manager, force_upload))
-            t.start()
-            threads.append(t)
-            
-        for t in threads:
-            t.join()
-            
-        if error_list:
-            print(f"Upload/Hash check completed with {len(error_list)} errors.")
-            sys.exit(1)
+        scan_errors = []
+        try:
+            if accepting(targets):
+                log.info("Scanning local directory...")
+                # Daemon so an aborted run can't hang on a full scan queue
+                scanner = threading.Thread(target=scan_stage, args=(local_dir, exclude_matcher, scan_queue, local_files, scan_errors, metrics, lambda rel_dir: dispatch(targets, 'need_dir', rel_dir)), daemon=True)
+                scanner.start()
 
-        # Collect results
-        new_hashes = {}
-        while not result_queue.empty():
-            rel_path, h = result_queue.get()
-            new_hashes[rel_path] = h
-
-        duration = time.time() - start_time
-        print(f"Processing completed in {duration:.2f}s")
-
-        # 7. (Removed) Extra Files Cleanup is now handled in worker tasks
-
-
-        # 8. Update Remote Hash File
-        print("Updating remote hash file...")
-        # We update the manager with ALL current local files (sync state)
-        for rel_path, h in new_hashes.items():
-            hash_manager.update_local_hash(rel_path, h)
-        
-        # Note: This logic only Adds/Updates. It doesn't remove deleted files from hash list.
-        # If we want to clean up hash list for files that no longer exist locally:
-        hash_manager.hashes = new_hashes 
-        
-        if not dry_run:
-            client.upload_hashes(hash_file_remote_path, hash_manager.to_json())
-            print("Done.")
-        else:
-            print("Dry run: Would update remote hash file.")
-            print("Done.")
+                with metrics.timer('hash'):
+                    new_hashes = hash_stage(local_dir, scan_queue, targets, error_list, force_upload, stat_cache, hash_workers)
+                log.info(f"Found {len(local_files)} files.")
+                for target in targets:
+                    target.error_list.extend(error_list + scan_errors)
+                dispatch(targets, 'finish_scan', local_files, scan_errors)
+        finally:
+            for target in targets:
+                target.stop()
+
+        # Local hashes are valid regardless of how the upload went
+        if stat_cache:
+            stat_cache.save()
 
+        # 3. Check the uploads, update the hash files and activate releases
+        run_targets(targets, 'finish', new_hashes)
+
+        failed = [target.name for target in targets if target.failed]
+        if len(targets) > 1:
+            log.result(f"Deployed to {len(targets) - len(failed)} of {len(targets)} targets{'; failed: ' + ', '.join(failed) if failed else '.'}")
     finally:
-        if client:
-            client.close()
+        for target in targets:
+            target.close()
+        publish_metrics(metrics, report_file, targets if len(targets) > 1 else None)
+        log.stop()
+
+    if failed:
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,198 @@
+import contextlib
+import heapq
+import json
+import threading
+import time
+
+# Number of slowest file transfers kept for the report
+SLOWEST_FILES = 10
+
+# Phases in report order. The scan, hash, upload and delete stages run as a
+# pipeline, so their spans overlap.
+PHASES = ('connect', 'manifest_download', 'verify', 'scan', 'hash', 'mkdir', 'upload', 'move', 'link', 'delete', 'manifest_upload', 'release')
+
+class Metrics:
+    """
+    Thread-safe run instrumentation: the wall-clock span of each phase,
+    file and byte counters, per-worker busy time and the slowest transfers.
+    """
+    def __init__(self, slowest=SLOWEST_FILES):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.end_time = None
+        self.slowest = slowest
+        # phase -> [first start, last end], as time.time() values
+        self.phases = {}
+        self.counters = dict.fromkeys((
+            'files_scanned', 'files_uploaded', 'bytes_uploaded', 'files_skipped',
+            'bytes_skipped', 'files_drifted', 'files_moved', 'files_linked', 'bytes_deduplicated', 'files_reused', 'files_deleted', 'files_failed', 'dirs_created',
+        ), 0)
+        # worker id -> [started, stopped, busy seconds, tasks]
+        self.workers = {}
+        self.slowest_files = []
+
+    def span(self, phase, start, end):
+        """Extend a phase to cover start..end."""
+        with self.lock:
+            current = self.phases.get(phase)
+            if current:
+                current[0] = min(current[0], start)
+                current[1] = max(current[1], end)
+            else:
+                self.phases[phase] = [start, end]
+
+    @contextlib.contextmanager
+    def timer(self, phase):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.span(phase, start, time.time())
+
+    def add(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] += value
+
+    def worker_started(self, worker_id):
+        with self.lock:
+            self.workers[worker_id] = [time.time(), None, 0.0, 0]
+
+    def worker_stopped(self, worker_id):
+        with self.lock:
+            self.workers[worker_id][1] = time.time()
+
+    def record_task(self, worker_id, phase, rel_path, size, start):
+        """Record a finished upload, move, link or delete task of a worker."""
+        end = time.time()
+        self.span(phase, start, end)
+        with self.lock:
+            worker = self.workers[worker_id]
+            worker[2] += end - start
+            worker[3] += 1
+            if phase == 'upload':
+                entry = (end - start, rel_path, size)
+                if len(self.slowest_files) < self.slowest:
+                    heapq.heappush(self.slowest_files, entry)
+                else:
+                    heapq.heappushpop(self.slowest_files, entry)
+
+    def finish(self):
+        self.end_time = time.time()
+
+    def report(self):
+        with self.lock:
+            end_time = self.end_time or time.time()
+            duration = end_time - self.start_time
+            workers = {}
+            for worker_id, (started, stopped, busy, tasks) in sorted(self.workers.items()):
+                lifetime = (stopped or end_time) - started
+                workers[str(worker_id)] = {
+                    'tasks': tasks,
+                    'busy_seconds': round(busy, 3),
+                    'utilisation': round(busy / lifetime, 3) if lifetime > 0 else 0.0,
+                }
+            return {
+                'duration_seconds': round(duration, 3),
+                'phases': {
+                    phase: round(end - start, 3)
+                    for phase, (start, end) in sorted(self.phases.items(), key=lambda p: PHASES.index(p[0]))
+                },
+                'counters': dict(self.counters),
+                'upload_rate_bytes_per_second': round(self.counters['bytes_uploaded'] / duration, 1) if duration > 0 else 0.0,
+                'workers': workers,
+                'slowest_files': [
+                    {'path': rel_path, 'size': size, 'seconds': round(seconds, 3)}
+                    for seconds, rel_path, size in sorted(self.slowest_files, reverse=True)
+                ],
+            }
+
+    def write_report(self, path, report=None):
+        with open(path, 'w') as f:
+            json.dump(report or self.report(), f, indent=2)
+
+    def write_outputs(self, path, report=None):
+        """Append the main figures as GitHub Actions step outputs ($GITHUB_OUTPUT)."""
+        report = report or self.report()
+        counters = report['counters']
+        outputs = {
+            'duration': report['duration_seconds'],
+            'filesUploaded': counters['files_uploaded'],
+            'bytesUploaded': counters['bytes_uploaded'],
+            'filesSkipped': counters['files_skipped'],
+            'filesDrifted': counters['files_drifted'],
+            'filesMoved': counters['files_moved'],
+            'filesLinked': counters['files_linked'],
+            'filesDeleted': counters['files_deleted'],
+            'filesFailed': counters['files_failed'],
+            'failedTargets': ','.join(name for name, target in report.get('targets', {}).items() if target['failed']),
+        }
+        with open(path, 'a') as f:
+            for name, value in outputs.items():
+                f.write(f"{name}={value}\n")
+
+    def write_summary(self, path, report=None):
+        """Append a Markdown summary of the run ($GITHUB_STEP_SUMMARY)."""
+        report = report or self.report()
+        counters = report['counters']
+        lines = [
+            '### SFTP Upload',
+            '',
+            f"Completed in {report['duration_seconds']:.2f}s: "
+            f"{counters['files_uploaded']} uploaded ({format_bytes(counters['bytes_uploaded'])}), "
+            f"{counters['files_skipped']} unchanged ({format_bytes(counters['bytes_skipped'])}), "
+            f"{counters['files_moved']} moved, {counters['files_linked']} linked, {counters['files_deleted']} deleted, {counters['files_failed']} failed.",
+            '',
+            '| Phase | Seconds |',
+            '| :--- | ---: |',
+        ]
+        lines += [f"| {phase} | {seconds:.2f} |" for phase, seconds in report['phases'].items()]
+        if report['workers']:
+            lines += ['', '| Worker | Tasks | Busy (s) | Utilisation |', '| :--- | ---: | ---: | ---: |']
+            lines += [
+                f"| {worker_id} | {w['tasks']} | {w['busy_seconds']:.2f} | {w['utilisation']:.0%} |"
+                for worker_id, w in report['workers'].items()
+            ]
+        if report.get('targets'):
+            lines += ['', '| Target | Uploaded | Unchanged | Deleted | Failed files | Seconds | Status |', '| :--- | ---: | ---: | ---: | ---: | ---: | :--- |']
+            lines += [
+                f"| {name} | {t['counters']['files_uploaded']} | {t['counters']['files_skipped']} | {t['counters']['files_deleted']} | "
+                f"{t['counters']['files_failed']} | {t['duration_seconds']:.2f} | {'failed' if t['failed'] else 'ok'} |"
+                for name, t in report['targets'].items()
+            ]
+        if report['slowest_files']:
+            lines += ['', '| Slowest files | Size | Seconds |', '| :--- | ---: | ---: |']
+            lines += [
+                f"| `{f['path']}` | {format_bytes(f['size'])} | {f['seconds']:.2f} |"
+                for f in report['slowest_files']
+            ]
+        with open(path, 'a') as f:
+            f.write('\n'.join(lines) + '\n\n')
+
+def combine_reports(report, target_reports):
+    """
+    Fold the reports of several targets into the report of the shared scan
+    and hash stages: counters are summed, the slowest files merged, and each
+    target's own report is kept under 'targets'.
+    """
+    combined = dict(report)
+    counters = dict(report['counters'])
+    for target_report in target_reports.values():
+        for name, value in target_report['counters'].items():
+            # Every target sees the same scan
+            if name != 'files_scanned':
+                counters[name] += value
+    combined['counters'] = counters
+    duration = report['duration_seconds']
+    combined['upload_rate_bytes_per_second'] = round(counters['bytes_uploaded'] / duration, 1) if duration > 0 else 0.0
+    combined['slowest_files'] = sorted(
+        (f for target_report in target_reports.values() for f in target_report['slowest_files']),
+        key=lambda f: f['seconds'], reverse=True,
+    )[:SLOWEST_FILES]
+    combined['targets'] = target_reports
+    return combined
+
+def format_bytes(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024 or unit == 'GiB':
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
@@ -0,0 +1,65 @@
+import posixpath
+import stat
+
+from logger import log
+
+# Layout of a release deploy under remoteDir:
+#   releases/<id>/   one complete copy of the site per deploy
+#   current          symlink to the active release
+RELEASES_DIR = 'releases'
+CURRENT_LINK = 'current'
+
+def release_path(remote_dir, release_id):
+    return posixpath.join(remote_dir, RELEASES_DIR, release_id)
+
+def current_release(sftp, remote_dir):
+    """Return the id of the release `current` points to, or None."""
+    try:
+        target = sftp.readlink(posixpath.join(remote_dir, CURRENT_LINK))
+    except IOError:
+        return None
+    return posixpath.basename(target.rstrip('/')) if target else None
+
+def activate_release(sftp, remote_dir, release_id):
+    """
+    Point `current` at a release by creating a new symlink next to it and
+    renaming it over the old one, so the switch is atomic for visitors.
+    """
+    current_path = posixpath.join(remote_dir, CURRENT_LINK)
+    temp_path = f"{current_path}.tmp"
+    try:
+        sftp.remove(temp_path)
+    except IOError:
+        pass
+    sftp.symlink(posixpath.join(RELEASES_DIR, release_id), temp_path)
+    sftp.posix_rename(temp_path, current_path)
+
+def remove_tree(sftp, remote_path):
+    """Recursively delete a remote directory."""
+    for entry in sftp.listdir_attr(remote_path):
+        entry_path = posixpath.join(remote_path, entry.filename)
+        if stat.S_ISDIR(entry.st_mode):
+            remove_tree(sftp, entry_path)
+        else:
+            sftp.remove(entry_path)
+    sftp.rmdir(remote_path)
+
+def prune_releases(sftp, remote_dir, keep, current_id):
+    """
+    Delete all but the newest `keep` releases, never the active one.
+    Releases are ordered by modification time, as ids are free-form (e.g.
+    commit SHAs). Returns the ids removed.
+    """
+    releases_dir = posixpath.join(remote_dir, RELEASES_DIR)
+    entries = sorted(sftp.listdir_attr(releases_dir), key=lambda entry: (entry.st_mtime or 0, entry.filename), reverse=True)
+    releases = [entry.filename for entry in entries]
+    removed = []
+    for release_id in releases[keep:]:
+        if release_id == current_id:
+            continue
+        try:
+            remove_tree(sftp, posixpath.join(releases_dir, release_id))
+            removed.append(release_id)
+        except IOError as e:
+            log.warning(f"Warning: Failed to remove release {release_id}: {e}")
+    return removed
@@ -0,0 +1,138 @@
+import bisect
+import collections
+import itertools
+import queue
+import threading
+
+SCHEDULE_POLICIES = ('fifo', 'largest-first', 'interleave')
+
+class TaskScheduler(queue.Queue):
+    """
+    Bounded task queue that hands out upload tasks according to a policy:
+
+    - fifo: in the order the files were found.
+    - largest-first: biggest file first (LPT), so a huge file found late
+      doesn't become a long tail after everything else is done.
+    - interleave: alternately the biggest and the smallest file, so the big
+      ones start early while small files keep the other workers busy.
+
+    Ordering applies to the tasks waiting in the queue at the time, i.e.
+    within the queue's capacity. Tasks are (action, rel_path, size) tuples;
+    None sentinels are always handed out after every real task.
+    """
+    def __init__(self, maxsize=0, policy='fifo'):
+        if policy not in SCHEDULE_POLICIES:
+            raise ValueError(f"Unknown schedule policy: {policy}. Supported: {', '.join(SCHEDULE_POLICIES)}.")
+        self.policy = policy
+        super().__init__(maxsize)
+
+    # queue.Queue storage hooks, called with the queue's lock held
+
+    def _init(self, maxsize):
+        self.tasks = collections.deque() if self.policy == 'fifo' else []
+        self.sentinels = 0
+        self.sequence = itertools.count()
+        self.take_largest = True
+
+    def _qsize(self):
+        return len(self.tasks) + self.sentinels
+
+    def _put(self, task):
+        if task is None:
+            self.sentinels += 1
+        elif self.policy == 'fifo':
+            self.tasks.append(task)
+        else:
+            # Sorted by size; the sequence number keeps equal sizes in order
+            bisect.insort(self.tasks, (task[2], -next(self.sequence), task))
+
+    def _get(self):
+        if not self.tasks:
+            self.sentinels -= 1
+            return None
+        if self.policy == 'fifo':
+            return self.tasks.popleft()
+        if self.policy == 'interleave':
+            take_largest = self.take_largest
+            self.take_largest = not take_largest
+            if not take_largest:
+                return self.tasks.pop(0)[2]
+        return self.tasks.pop()[2]
+
+class DuplicateTracker:
+    """
+    Tracks which content is already on the server in this run, so every
+    unique hash is uploaded once and its other paths are hard-linked to it.
+
+    A path is either uploaded (the first one with its hash), linked to a
+    path already on the server, or attached to the upload in progress and
+    handed back by finish() once that upload is done.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # hash -> path on the server with that content
+        self.available = {}
+        # hash -> [(rel_path, size)] waiting for the upload in progress
+        self.waiting = {}
+        # Cleared once the server turns out not to support hard links
+        self.hardlinks = True
+
+    def exists(self, file_hash, rel_path):
+        """Record an unchanged path already on the server."""
+        with self.lock:
+            self.available.setdefault(file_hash, rel_path)
+
+    def add(self, file_hash, rel_path, size):
+        """
+        Return the (action, source) to queue for a changed path: ('upload',
+        None), ('link', path on the server), or (None, None) when it was
+        attached to the upload in progress.
+        """
+        with self.lock:
+            if not self.hardlinks:
+                return 'upload', None
+            if file_hash in self.available:
+                return 'link', self.available[file_hash]
+            if file_hash in self.waiting:
+                self.waiting[file_hash].append((rel_path, size))
+                return None, None
+            self.waiting[file_hash] = []
+            return 'upload', None
+
+    def finish(self, file_hash, rel_path):
+        """
+        Record the upload of a hash as finished at rel_path (None if it
+        failed) and return the paths that were waiting for it.
+        """
+        with self.lock:
+            if rel_path:
+                self.available[file_hash] = rel_path
+            return self.waiting.pop(file_hash, [])
+
+class TarBatcher:
+    """
+    Groups small files into batches that are uploaded together, as one tar
+    stream or with pipelined requests.
+    add() returns a full batch, flush() whatever is left; batches are lists
+    of (rel_path, size, hash).
+    """
+    def __init__(self, threshold, max_files, max_bytes):
+        self.threshold = threshold
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.batch = []
+        self.batch_bytes = 0
+
+    def accepts(self, size):
+        return size < self.threshold
+
+    def add(self, rel_path, size, file_hash):
+        self.batch.append((rel_path, size, file_hash))
+        self.batch_bytes += size
+        if len(self.batch) >= self.max_files or self.batch_bytes >= self.max_bytes:
+            return self.flush()
+        return None
+
+    def flush(self):
+        batch, self.batch, self.batch_bytes = self.batch, [], 0
+        return batch
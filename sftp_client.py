@@ -1,19 +1,113 @@
+import collections
+import hmac
 import os
 import paramiko
+import posixpath
+import shlex
 import stat
+import tarfile
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from paramiko.sftp import (
+    CMD_ATTRS, CMD_CLOSE, CMD_EXTENDED, CMD_FSTAT, CMD_HANDLE, CMD_MKDIR, CMD_OPEN, CMD_REMOVE, CMD_RMDIR, CMD_STAT, CMD_STATUS, CMD_WRITE,
+    SFTP_FLAG_CREATE, SFTP_FLAG_TRUNC, SFTP_FLAG_WRITE, SFTP_OP_UNSUPPORTED, int64,
+)
+
+from logger import log
+
+# Local read size when streaming a file to the server
+CHUNK_READ_SIZE = 1024 * 1024
+
+# Maximum number of requests in flight when pipelining
+PIPELINE_WINDOW = 64
+
+# threads: each worker uploads one file at a time; pipelined: small files
+# are uploaded in batches with the requests of many files in flight
+ENGINES = ('threads', 'pipelined')
+
+# Requests in flight per channel with the pipelined engine, and the size of
+# each write request (as paramiko's SFTPFile sends them)
+ENGINE_WINDOW = 256
+WRITE_REQUEST_SIZE = 32 * 1024
+
+# on: offer zlib on every connection, off: never, auto: also open an
+# uncompressed connection for files that won't compress
+COMPRESSION_POLICIES = ('on', 'off', 'auto')
+
+# Data encrypted per cipher by the startup benchmark, in SSH-sized packets
+CIPHER_BENCHMARK_BYTES = 4 * 1024 * 1024
+CIPHER_BENCHMARK_PACKET = 32 * 1024
 
 class SFTPClientWrapper:
-    def __init__(self, host, port, username, password=None, key_data=None, passphrase=None):
-        self.transport = paramiko.Transport((host, int(port)))
-        self.transport.use_compression(True) # Enable compression if supported
-        
-        if key_data:
-            pkey = self._load_private_key(key_data, passphrase)
-            self.transport.connect(username=username, pkey=pkey)
+    def __init__(self, host, port, username, password=None, key_data=None, passphrase=None, window_size=None, max_packet_size=None, ciphers=None, macs=None, kex=None, compression=True):
+        self.host = host
+        self.port = int(port)
+        self.username = username
+        self.password = password
+        self.pkey = self._load_private_key(key_data, passphrase) if key_data else None
+        # Only override paramiko's defaults when asked to
+        self.transport_options = {}
+        if window_size:
+            self.transport_options['default_window_size'] = window_size
+        if max_packet_size:
+            self.transport_options['default_max_packet_size'] = max_packet_size
+        # Preferred algorithms in order, None keeps paramiko's order
+        self.ciphers = ciphers
+        self.macs = macs
+        self.kex = kex
+        self.compression = compression
+        self.transport = None
+        self.connect()
+
+    def connect(self):
+        """
+        Open and authenticate a new transport, replacing any previous one.
+        """
+        if self.transport:
+            self.transport.close()
+
+        self.transport = paramiko.Transport((self.host, self.port), **self.transport_options)
+        options = self.transport.get_security_options()
+        if self.ciphers:
+            options.ciphers = self.ciphers
+        if self.macs:
+            options.digests = self.macs
+        if self.kex:
+            options.kex = self.kex
+        # Offer zlib if asked to; the server may still decline it
+        self.transport.use_compression(self.compression)
+
+        if self.pkey:
+            self.transport.connect(username=self.username, pkey=self.pkey)
         else:
-            self.transport.connect(username=username, password=password)
-            
+            self.transport.connect(username=self.username, password=self.password)
+
+    def is_active(self):
+        return self.transport is not None and self.transport.is_active()
+
+    def negotiated(self):
+        """Describe the cipher and MAC the server agreed on."""
+        cipher = self.transport.local_cipher
+        aead = paramiko.Transport._cipher_info.get(cipher, {}).get('is_aead')
+        return cipher if aead else f"{cipher}, {self.transport.local_mac}"
+
+    def exec_available(self):
+        """
+        Check whether the server runs commands on exec channels and has tar,
+        which SFTP-only accounts (internal-sftp, ForceCommand) don't allow.
+        """
+        try:
+            channel = self.transport.open_session()
+            try:
+                channel.exec_command('command -v tar')
+                channel.shutdown_write()
+                return channel.recv_exit_status() == 0
+            finally:
+                channel.close()
+        except Exception:
+            return False
+
     def _load_private_key(self, key_data, passphrase):
         import io
         
@@ -58,20 +152,22 @@ class SFTPClientWrapper:
         return paramiko.SFTPClient.from_transport(self.transport)
 
     def download_hashes(self, remote_path):
+        """Return the raw (possibly compressed) content of a hash file, or None."""
         sftp = self.create_sftp()
         try:
             with sftp.open(remote_path, 'r') as f:
-                return f.read().decode('utf-8')
+                return f.read()
         except IOError:
             return None
         finally:
             sftp.close()
 
-    def upload_hashes(self, remote_path, json_content):
+    def upload_hashes(self, remote_path, content):
         sftp = self.create_sftp()
         try:
+            ensure_dir_exists(sftp, os.path.dirname(remote_path))
             with sftp.open(remote_path, 'w') as f:
-                f.write(json_content)
+                f.write(content)
         finally:
             sftp.close()
 
@@ -121,34 +217,401 @@ class SFTPClientWrapper:
             sftp.close()
 
 
+class SFTPConnectionPool:
+    """
+    A pool of independently authenticated transports.
+    Workers are spread round-robin across the pool members so that concurrent
+    uploads don't all share one TCP connection, cipher thread and window.
+
+    With compression 'auto', each member gets an uncompressed twin, opened
+    the first time a worker asks for a channel without compression.
+    """
+    def __init__(self, connections=1, compression='on', **connect_kwargs):
+        self.compression = compression
+        self.connect_kwargs = connect_kwargs
+        self.members = []
+        self.locks = []
+        self.plain_members = []
+        try:
+            for _ in range(max(1, connections)):
+                self.members.append(SFTPClientWrapper(compression=compression != 'off', **connect_kwargs))
+                self.locks.append(threading.Lock())
+                self.plain_members.append(None)
+        except Exception:
+            self.close()
+            raise
+
+    def _index(self, worker_id):
+        return (worker_id - 1) % len(self.members)
+
+    def is_active(self, worker_id):
+        return self.members[self._index(worker_id)].is_active()
+
+    def _active_member(self, index, compressed=True):
+        """
+        Return the pool member at index, reconnecting it first if its
+        transport has died.
+        """
+        with self.locks[index]:
+            if not compressed and self.compression == 'auto':
+                member = self.plain_members[index]
+                if member is None:
+                    member = self.plain_members[index] = SFTPClientWrapper(compression=False, **self.connect_kwargs)
+                    return member
+            else:
+                member = self.members[index]
+            if not member.is_active():
+                log.warning(f"Connection {index + 1} lost, reconnecting...")
+                member.connect()
+        return member
+
+    def create_sftp(self, worker_id=1, compressed=True):
+        """
+        Open a new SFTP channel on the pool member assigned to this worker,
+        on its uncompressed twin if compressed is False and the policy is auto.
+        """
+        return self._active_member(self._index(worker_id), compressed).create_sftp()
+
+    def negotiated(self):
+        return self.members[0].negotiated()
+
+    def download_hashes(self, remote_path):
+        return self._active_member(0).download_hashes(remote_path)
+
+    def exec_available(self):
+        return self._active_member(0).exec_available()
+
+    def upload_hashes(self, remote_path, content):
+        self._active_member(0).upload_hashes(remote_path, content)
+
+    def close(self):
+        for member in self.members + self.plain_members:
+            if member:
+                member.close()
+
+
+def supported_algorithms():
+    """Cipher, MAC and key exchange names this paramiko can negotiate."""
+    return {
+        'ciphers': tuple(paramiko.Transport._cipher_info),
+        'macs': tuple(paramiko.Transport._mac_info),
+        'kex': tuple(paramiko.Transport._kex_info),
+    }
+
+def benchmark_ciphers(ciphers, mac='hmac-sha2-256', size=CIPHER_BENCHMARK_BYTES):
+    """
+    Encrypt size bytes in SSH-sized packets with each cipher the way
+    paramiko does, including the MAC for non-AEAD ciphers, and return the
+    ciphers sorted fastest first with their rates in bytes per second.
+    Encryption runs in Python's transport thread, so on fast links the
+    cipher is often what limits a connection.
+    """
+    packet = os.urandom(CIPHER_BENCHMARK_PACKET)
+    mac_info = paramiko.Transport._mac_info[mac]
+    mac_key = os.urandom(mac_info['size'])
+    rates = []
+    for name in ciphers:
+        info = paramiko.Transport._cipher_info[name]
+        key = os.urandom(info['key-size'])
+        if info.get('is_aead'):
+            engine = info['class'](key)
+            nonce = os.urandom(info['iv-size'])
+            encrypt = lambda data: engine.encrypt(nonce, data, data[:4])
+        else:
+            from cryptography.hazmat.primitives.ciphers import Cipher
+            encryptor = Cipher(info['class'](key), info['mode'](os.urandom(info['block-size']))).encryptor()
+            encrypt = lambda data: (encryptor.update(data), hmac.new(mac_key, data, mac_info['class']).digest())
+        start = time.perf_counter()
+        for _ in range(max(1, size // len(packet))):
+            encrypt(packet)
+        rates.append((name, size / max(time.perf_counter() - start, 1e-9)))
+    return sorted(rates, key=lambda rate: rate[1], reverse=True)
+
+def temporary_path(remote_path, tag):
+    """Hidden name next to remote_path to write to before renaming it into place."""
+    remote_dir, name = os.path.split(remote_path)
+    return f"{remote_dir}/.{name}.{tag}.tmp" if remote_dir else f".{name}.{tag}.tmp"
+
+class UnsupportedOperation(IOError):
+    """The server answered a request with SFTP_OP_UNSUPPORTED."""
+
+def _extended_request(sftp, name, *args):
+    collector = _ResponseCollector()
+    num = sftp._async_request(collector, CMD_EXTENDED, name, *args)
+    while num not in collector.responses:
+        sftp._read_response()
+    t, msg = collector.responses[num]
+    if t == CMD_STATUS:
+        start = msg.packet.tell()
+        if msg.get_int() == SFTP_OP_UNSUPPORTED:
+            raise UnsupportedOperation(f"{name} is not supported by the server")
+        msg.packet.seek(start)
+        sftp._convert_status(msg)
+
+def hardlink(sftp, source_path, link_path):
+    """
+    Create link_path as a hard link to source_path on the server, using the
+    hardlink@openssh.com extension. Raises UnsupportedOperation when the
+    server lacks it.
+    """
+    _extended_request(sftp, 'hardlink@openssh.com', source_path, link_path)
+
+def links_supported(sftp, remote_dir, rename=True):
+    """
+    Whether the server has the hardlink@openssh.com extension and, with
+    rename, posix-rename@openssh.com. Each is tried on a path that doesn't
+    exist, which a server with the extension answers with an error about
+    the path.
+    """
+    missing = posixpath.join(remote_dir, '.sftp_upload_action_probe')
+    for name in ('hardlink@openssh.com', 'posix-rename@openssh.com') if rename else ('hardlink@openssh.com',):
+        try:
+            _extended_request(sftp, name, missing, missing + '.tmp')
+        except UnsupportedOperation:
+            return False
+        except (IOError, EOFError):
+            pass
+    return True
+
+def upload_files_tar(transport, files, remote_dir):
+    """
+    Upload many small files in one round trip by streaming them as a tar
+    archive into `tar -x` on an exec channel. files is a list of
+    (local path, path relative to remote_dir). Raises IOError if tar fails.
+    """
+    quoted_dir = shlex.quote(remote_dir)
+    channel = transport.open_session()
+    try:
+        # -m: stamp files with the extraction time, like writes over SFTP
+        channel.exec_command(f"mkdir -p {quoted_dir} && tar -xmf - -C {quoted_dir}")
+        with channel.makefile('wb') as stream:
+            with tarfile.open(fileobj=stream, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+                for local_path, rel_path in files:
+                    with open(local_path, 'rb') as f:
+                        # From the open file, so symlinks are sent as their content
+                        info = tar.gettarinfo(arcname=rel_path, fileobj=f)
+                        info.uid = info.gid = 0
+                        info.uname = info.gname = ''
+                        tar.addfile(info, f)
+        channel.shutdown_write()
+        status = channel.recv_exit_status()
+        if status != 0:
+            error = channel.makefile_stderr('rb').read().decode('utf-8', 'replace').strip()
+            raise IOError(f"remote tar exited with status {status}: {error}")
+    finally:
+        channel.close()
+
+class _PipelinedFile:
+    def __init__(self, local_path, target_path, final_path):
+        self.local_path = local_path
+        self.target_path = target_path
+        self.final_path = final_path
+        self.data = None
+        self.handle = None
+        self.writes = 0
+        self.error = None
+
+def upload_files_pipelined(sftp, files, confirm=True, window=ENGINE_WINDOW):
+    """
+    Upload many small files over one channel without waiting for each reply.
+    Every file goes through open, write, (fstat,) close and, if its target
+    path differs from its final path, rename (or remove, if it failed). The
+    requests of different files are interleaved with up to `window` in
+    flight, so a batch takes a few round trips rather than several per file. files is a list of
+    (local path, target path, final path). Returns final path -> None, or
+    the exception that file failed with.
+    """
+    results = {}
+    pending = {}
+    responses = collections.deque()
+    waiting = collections.deque(_PipelinedFile(*f) for f in files)
+
+    class Collector:
+        def _async_response(self, t, msg, num):
+            responses.append((num, t, msg))
+
+    collector = Collector()
+
+    def send(entry, step, t, *args):
+        pending[sftp._async_request(collector, t, *args)] = (entry, step)
+
+    def status_error(t, msg):
+        if t != CMD_STATUS:
+            return IOError(f"Unexpected SFTP response type {t}")
+        try:
+            sftp._convert_status(msg)
+        except (IOError, EOFError) as e:
+            return e if isinstance(e, IOError) else IOError(str(e))
+        return None
+
+    def start(entry):
+        try:
+            with open(entry.local_path, 'rb') as f:
+                entry.data = f.read()
+        except OSError as e:
+            results[entry.final_path] = e
+            return
+        flags = SFTP_FLAG_WRITE | SFTP_FLAG_CREATE | SFTP_FLAG_TRUNC
+        send(entry, 'open', CMD_OPEN, entry.target_path, flags, paramiko.SFTPAttributes())
+
+    def written(entry):
+        if confirm and not entry.error:
+            send(entry, 'stat', CMD_FSTAT, entry.handle)
+        else:
+            send(entry, 'close', CMD_CLOSE, entry.handle)
+
+    def receive(entry, step, t, msg):
+        if step == 'open':
+            if t != CMD_HANDLE:
+                results[entry.final_path] = status_error(t, msg) or IOError(f"Failed to open {entry.target_path}")
+                return
+            entry.handle = msg.get_binary()
+            data = entry.data
+            for offset in range(0, len(data), WRITE_REQUEST_SIZE):
+                send(entry, 'write', CMD_WRITE, entry.handle, int64(offset), data[offset:offset + WRITE_REQUEST_SIZE])
+                entry.writes += 1
+            entry.data = None
+            if not entry.writes:
+                written(entry)
+        elif step == 'write':
+            entry.error = entry.error or status_error(t, msg)
+            entry.writes -= 1
+            if not entry.writes:
+                written(entry)
+        elif step == 'stat':
+            if t == CMD_ATTRS:
+                remote_size = paramiko.SFTPAttributes._from_msg(msg).st_size
+                size = os.path.getsize(entry.local_path)
+                if remote_size != size:
+                    entry.error = IOError(f"size mismatch in put!  {remote_size} != {size}")
+            else:
+                entry.error = status_error(t, msg)
+            send(entry, 'close', CMD_CLOSE, entry.handle)
+        elif step == 'close':
+            entry.error = entry.error or status_error(t, msg)
+            if entry.error or entry.target_path == entry.final_path:
+                done(entry, entry.error)
+            else:
+                send(entry, 'rename', CMD_EXTENDED, 'posix-rename@openssh.com', entry.target_path, entry.final_path)
+        elif step == 'rename':
+            done(entry, status_error(t, msg))
+
+    def done(entry, error):
+        results[entry.final_path] = error
+        # Never leave a temporary file behind
+        if error and entry.target_path != entry.final_path:
+            send(entry, 'cleanup', CMD_REMOVE, entry.target_path)
+
+    while waiting or pending:
+        while waiting and len(pending) < window:
+            start(waiting.popleft())
+        if not pending:
+            continue
+        sftp._read_response()
+        while responses:
+            num, t, msg = responses.popleft()
+            entry, step = pending.pop(num)
+            receive(entry, step, t, msg)
+    return results
+
+class DirectoryCache:
+    """
+    Remote directories known to exist, shared by all workers of a target.
+    Seeded from the hash file and filled by make_remote_dirs, so uploads
+    rarely need a directory round trip of their own.
+    """
+    def __init__(self, remote_dirs=()):
+        self.lock = threading.Lock()
+        self.dirs = set(remote_dirs)
+
+    def __contains__(self, remote_dir):
+        return remote_dir in self.dirs
+
+    def add(self, remote_dir):
+        with self.lock:
+            self.dirs.add(remote_dir)
+
+    def discard(self, remote_dir):
+        """
+        Forget a directory that turned out to be gone, with everything below
+        it and its parents, which may be gone too (e.g. after `rm -rf` on a
+        tracked tree), so ensure_dir_exists checks again from the top.
+        """
+        prefix = remote_dir.rstrip('/') + '/'
+        parents = set()
+        parent = posixpath.dirname(remote_dir)
+        while parent not in parents:
+            parents.add(parent)
+            parent = posixpath.dirname(parent)
+        with self.lock:
+            self.dirs = {d for d in self.dirs if d != remote_dir and d not in parents and not d.startswith(prefix)}
+
+def make_remote_dirs(sftp, remote_dirs, cache):
+    """
+    Create the given directories and their parents, skipping those in the
+    cache. Parents come first: each depth is one pipelined mkdir pass, and
+    one pipelined stat pass checks the directories mkdir failed on, as it
+    also fails when they already exist. Directories found or created are
+    added to the cache; the rest are left to ensure_dir_exists to report.
+    Returns the number of directories created.
+    """
+    missing = set()
+    for remote_dir in remote_dirs:
+        while remote_dir not in ('', '/', '.') and remote_dir not in cache and remote_dir not in missing:
+            missing.add(remote_dir)
+            remote_dir = posixpath.dirname(remote_dir)
+    by_depth = collections.defaultdict(list)
+    for remote_dir in missing:
+        by_depth[remote_dir.count('/')].append(remote_dir)
+
+    attributes = paramiko.SFTPAttributes()
+    attributes.st_mode = 0o777
+    created = 0
+    failed = []
+    for depth in sorted(by_depth):
+        dirs = by_depth[depth]
+        for remote_dir, result in zip(dirs, pipelined_requests(sftp, CMD_MKDIR, dirs, args=(attributes,))):
+            if result is True:
+                cache.add(remote_dir)
+                created += 1
+            else:
+                failed.append(remote_dir)
+    if failed:
+        for remote_dir, result in zip(failed, pipelined_requests(sftp, CMD_STAT, failed)):
+            if not isinstance(result, Exception) and stat.S_ISDIR(result.st_mode or 0):
+                cache.add(remote_dir)
+    return created
+
 def ensure_dir_exists(sftp, remote_dir, cache=None):
     """
     Ensure a directory exists on the remote server, creating it if necessary.
-    Handles recursive creation.
+    Handles recursive creation. Returns the number of directories created.
     """
     remote_dir = remote_dir.replace('\\', '/')
     if cache is not None and remote_dir in cache:
-        return
+        return 0
 
     # Base case: root or empty
     if not remote_dir or remote_dir == '/':
-        return
+        return 0
 
     # Check if exists
     try:
         sftp.stat(remote_dir)
         if cache is not None:
             cache.add(remote_dir)
-        return
+        return 0
     except IOError:
         # Doesn't exist (or permission denied), try to create parent first
+        created = 0
         parent = os.path.dirname(remote_dir)
         if parent and parent != remote_dir:
-            ensure_dir_exists(sftp, parent, cache)
+            created = ensure_dir_exists(sftp, parent, cache)
         
         # Now create this dir
         try:
             sftp.mkdir(remote_dir)
+            created += 1
         except IOError:
             # Check again, maybe created by another worker
             try:
@@ -159,17 +622,232 @@ def ensure_dir_exists(sftp, remote_dir, cache=None):
         
         if cache is not None:
             cache.add(remote_dir)
+        return created
 
 
 
-def upload_file_with_client(sftp, local_path, remote_path):
+def upload_file_with_client(sftp, local_path, remote_path, buffer_size=CHUNK_READ_SIZE, confirm=True):
     """
     Upload a single file using an existing SFTP client instance.
+    Writes are pipelined; with confirm=False the final stat round trip is
+    skipped and the caller is expected to verify the size later
+    (see verify_remote_sizes). Returns the number of bytes uploaded.
     """
     try:
-        # Optimization: Set window size and packet size for speed if needed
-        # sftp.get_channel().set_window_size(2 * 1024 * 1024)
-        sftp.put(local_path, remote_path)
+        size = 0
+        with open(local_path, 'rb') as local_file, sftp.open(remote_path, 'wb') as remote_file:
+            # Don't wait for each write to be acknowledged
+            remote_file.set_pipelined(True)
+            for chunk in iter(lambda: local_file.read(buffer_size), b""):
+                remote_file.write(chunk)
+                size += len(chunk)
+
+        if confirm:
+            remote_size = sftp.stat(remote_path).st_size
+            if remote_size != size:
+                raise IOError(f"size mismatch in put!  {remote_size} != {size}")
+        return size
     except Exception as e:
-        print(f"Error uploading {local_path}: {e}")
+        log.error(f"Error uploading {local_path}: {e}")
         raise e
+
+class _ResponseCollector:
+    """
+    Receives the responses of pipelined requests, in whatever order the
+    server sends them (duck-types paramiko's async response interface).
+    """
+    def __init__(self):
+        self.responses = {}
+
+    def _async_response(self, t, msg, num):
+        self.responses[num] = (t, msg)
+
+def pipelined_requests(sftp, command, paths, window=PIPELINE_WINDOW, args=()):
+    """
+    Send one single-path request (e.g. CMD_STAT, CMD_REMOVE) per path without
+    waiting for each reply, keeping up to `window` requests in flight; args
+    are sent after the path of each (e.g. the attributes of CMD_MKDIR).
+    Returns one result per path: the SFTPAttributes for attribute replies,
+    True for a successful status, or the IOError the server answered with.
+    """
+    collector = _ResponseCollector()
+    request_numbers = []
+    pending = 0
+    for path in paths:
+        request_numbers.append(sftp._async_request(collector, command, path, *args))
+        pending += 1
+        while pending >= window:
+            sftp._read_response()
+            pending = len(request_numbers) - len(collector.responses)
+    while len(collector.responses) < len(request_numbers):
+        sftp._read_response()
+
+    results = []
+    for num in request_numbers:
+        t, msg = collector.responses[num]
+        if t == CMD_ATTRS:
+            results.append(paramiko.SFTPAttributes._from_msg(msg))
+        elif t == CMD_STATUS:
+            try:
+                sftp._convert_status(msg)
+                results.append(True)
+            except (IOError, EOFError) as e:
+                results.append(e if isinstance(e, IOError) else IOError(str(e)))
+        else:
+            results.append(IOError(f"Unexpected SFTP response type {t}"))
+    return results
+
+def parallel_requests(client_pool, command, paths, workers):
+    """
+    Spread single-path requests over up to `workers` channels, each
+    pipelining its share with pipelined_requests. Returns path -> result.
+    """
+    results = {}
+
+    def run(worker_id, batch):
+        sftp = client_pool.create_sftp(worker_id)
+        try:
+            results.update(zip(batch, pipelined_requests(sftp, command, batch)))
+        finally:
+            sftp.close()
+
+    batches = [paths[i::workers] for i in range(workers) if paths[i::workers]]
+    with ThreadPoolExecutor(max_workers=max(1, len(batches))) as executor:
+        for future in [executor.submit(run, i + 1, batch) for i, batch in enumerate(batches)]:
+            future.result()
+    return results
+
+def verify_remote_sizes(client_pool, files, workers):
+    """
+    Check uploaded files in one batched pass: each of `workers` channels
+    pipelines the stat requests for its share of the (remote_path, size)
+    pairs. Returns a list of (remote_path, problem) for files that are
+    missing or have the wrong size.
+    """
+    results = parallel_requests(client_pool, CMD_STAT, [remote_path for remote_path, _ in files], workers)
+    problems = []
+    for remote_path, size in files:
+        result = results[remote_path]
+        if isinstance(result, Exception):
+            problems.append((remote_path, f"{result}"))
+        elif result.st_size != size:
+            problems.append((remote_path, f"size mismatch: local {size}, remote {result.st_size}"))
+    return problems
+
+def remove_remote_files(client_pool, remote_paths, workers):
+    """
+    Delete files with pipelined remove requests over up to `workers`
+    channels. Returns remote path -> None, or the IOError it failed with;
+    files that are already gone count as removed.
+    """
+    results = parallel_requests(client_pool, CMD_REMOVE, list(remote_paths), workers)
+    return {
+        remote_path: None if result is True or isinstance(result, FileNotFoundError) else result
+        for remote_path, result in results.items()
+    }
+
+def remove_empty_dirs(client_pool, remote_dirs, workers):
+    """
+    Remove the given directories where they are empty, deepest first, so a
+    parent emptied by removing its children goes too. Each depth is one
+    pipelined rmdir pass over up to `workers` channels; servers refuse to
+    remove directories that still hold files, and those are kept. Returns
+    the removed directories.
+    """
+    by_depth = collections.defaultdict(list)
+    for remote_dir in remote_dirs:
+        by_depth[remote_dir.count('/')].append(remote_dir)
+    removed = []
+    for depth in sorted(by_depth, reverse=True):
+        results = parallel_requests(client_pool, CMD_RMDIR, by_depth[depth], workers)
+        removed.extend(remote_dir for remote_dir, result in results.items() if result is True)
+    return removed
+
+def list_remote_tree(client_pool, remote_dir, workers):
+    """
+    Walk a remote tree with up to `workers` channels listing directories in
+    parallel, one listdir_attr round trip per directory. Returns a dict of
+    relative path -> (size, mtime) for every regular file; a missing
+    remote_dir is empty.
+    """
+    files = {}
+    local = threading.local()
+    channels = []
+    channels_lock = threading.Lock()
+
+    def list_dir(rel_dir):
+        if not hasattr(local, 'sftp'):
+            with channels_lock:
+                local.sftp = client_pool.create_sftp(len(channels) + 1)
+                channels.append(local.sftp)
+        try:
+            entries = local.sftp.listdir_attr(posixpath.join(remote_dir, rel_dir))
+        except FileNotFoundError:
+            return []
+        subdirs = []
+        for entry in entries:
+            rel_path = posixpath.join(rel_dir, entry.filename)
+            if stat.S_ISDIR(entry.st_mode):
+                subdirs.append(rel_path)
+            elif stat.S_ISREG(entry.st_mode):
+                files[rel_path] = (entry.st_size, entry.st_mtime)
+        return subdirs
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            pending = {executor.submit(list_dir, '')}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending |= {executor.submit(list_dir, subdir) for subdir in future.result()}
+    finally:
+        for sftp in channels:
+            sftp.close()
+    return files
+
+def _upload_range(client_pool, channel_id, local_path, remote_path, offset, length, compressed=True):
+    """
+    Write one byte range of a local file at the same offset of an existing
+    remote file, on its own SFTP channel.
+    """
+    sftp = client_pool.create_sftp(channel_id, compressed)
+    try:
+        with open(local_path, 'rb') as local_file, sftp.open(remote_path, 'r+') as remote_file:
+            # Don't wait for each write to be acknowledged
+            remote_file.set_pipelined(True)
+            local_file.seek(offset)
+            remote_file.seek(offset)
+            remaining = length
+            while remaining > 0:
+                chunk = local_file.read(min(CHUNK_READ_SIZE, remaining))
+                if not chunk:
+                    raise IOError(f"{local_path} shrank during upload")
+                remote_file.write(chunk)
+                remaining -= len(chunk)
+    finally:
+        sftp.close()
+
+
+def upload_file_chunked(client_pool, sftp, worker_id, local_path, remote_path, parts, compressed=True):
+    """
+    Upload a large file as byte ranges written concurrently through several
+    SFTP channels (spread over the pool's connections), then verify its size.
+    """
+    size = os.path.getsize(local_path)
+    part_size = -(-size // parts)
+
+    # Create the file at its final size so every range can be written in place
+    with sftp.open(remote_path, 'w') as f:
+        f.truncate(size)
+
+    with ThreadPoolExecutor(max_workers=parts) as executor:
+        futures = [
+            executor.submit(_upload_range, client_pool, worker_id + i, local_path, remote_path, offset, min(part_size, size - offset), compressed)
+            for i, offset in enumerate(range(0, size, part_size))
+        ]
+        for future in futures:
+            future.result()
+
+    remote_size = sftp.stat(remote_path).st_size
+    if remote_size != size:
+        raise IOError(f"Size mismatch after chunked upload of {local_path}: local {size}, remote {remote_size}")
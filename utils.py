@@ -1,69 +1,447 @@
 import os
+import collections
 import hashlib
-import fnmatch
+import gzip
 import json
+import math
+import mmap
+import posixpath
+import threading
+
+from logger import log
+from exclude import ExcludeMatcher
+
+# Current format of the remote hash file. Version 1 was a plain
+# {path: md5} JSON object without any header, version 3 is the sharded index.
+MANIFEST_VERSION = 2
+SHARDED_MANIFEST_VERSION = 3
+
+MANIFEST_COMPRESSIONS = ('gzip', 'zstd', 'none')
+
+HASH_ALGORITHMS = ('md5', 'sha1', 'sha256', 'blake2b', 'blake3', 'xxh3')
+
+# Read buffer for hashing, and the size from which files are mmapped instead
+HASH_BUFFER_SIZE = 1024 * 1024
+HASH_MMAP_THRESHOLD = 64 * 1024 * 1024
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# Formats that are already compressed, so zlib on the wire only costs CPU
+INCOMPRESSIBLE_EXTENSIONS = frozenset((
+    '.7z', '.avif', '.br', '.bz2', '.gif', '.gz', '.heic', '.jar', '.jpeg', '.jpg', '.lz4', '.m4a', '.mkv',
+    '.mov', '.mp3', '.mp4', '.ogg', '.pdf', '.png', '.rar', '.tgz', '.webm', '.webp', '.whl', '.woff', '.woff2',
+    '.xz', '.zip', '.zst',
+))
+
+# Other files are judged by the entropy of a sample from their start, in
+# bits per byte (8 is random data). Smaller files aren't worth checking.
+COMPRESSIBLE_SAMPLE_SIZE = 16 * 1024
+INCOMPRESSIBLE_ENTROPY = 7.5
+
+def compress_manifest(text, compression='gzip'):
+    """Encode hash file content, compressed with gzip, zstd (optional package) or not at all."""
+    data = text.encode('utf-8')
+    if compression == 'gzip':
+        return gzip.compress(data, mtime=0)
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor().compress(data)
+    return data
+
+def decompress_manifest(content):
+    """Decode hash file content, detecting the compression from its magic bytes."""
+    if isinstance(content, str):
+        return content
+    if content.startswith(GZIP_MAGIC):
+        content = gzip.decompress(content)
+    elif content.startswith(ZSTD_MAGIC):
+        import zstandard
+        content = zstandard.ZstdDecompressor().decompressobj().decompress(content)
+    return content.decode('utf-8')
+
+def _compact_json(data):
+    return json.dumps(data, separators=(',', ':'), sort_keys=True)
 
 class HashManager:
-    def __init__(self, hash_file_path):
+    """
+    Remote hash file (manifest) of relative path -> file hash.
+
+    When sharded, the hash file is a small index and the hashes are split by
+    top-level directory into separate files under `<hash file>.d/`. Shards are
+    only downloaded when one of their paths is looked up, and only shards
+    whose content changed are written back.
+    """
+    def __init__(self, hash_file_path, algorithm='md5', compression='gzip', sharded=False):
         self.hash_file_path = hash_file_path
+        self.algorithm = algorithm
+        self.compression = compression
+        self.sharded = sharded
+        # Algorithm of the hashes loaded from the server, which differs from
+        # self.algorithm on the run that switches hashAlgorithm
+        self.remote_algorithm = algorithm
         self.hashes = {}
+        # Called with a remote path, returns its content (or None) to load shards
+        self.shard_loader = None
+        self._shard_digests = {}
+        self._unloaded_shards = set()
+        # Shard -> Event set once it is loaded, for the shards being loaded
+        self._loading = {}
+        # Workers record completed files while checkpoints are being written
+        self.lock = threading.Lock()
+        self.dirty = False
+        # Set once hard links were created in the directory: they outlive the
+        # run, so paths must never be written in place again
+        self.hardlinks = False
 
-    def load(self, json_content):
+    @staticmethod
+    def links_recorded(content):
+        """Whether a hash file records that its directory holds hard links."""
         try:
-            if json_content:
-                self.hashes = json.loads(json_content)
+            data = json.loads(decompress_manifest(content)) if content else {}
+        except Exception:
+            return False
+        # A version 1 file is a bare {path: md5} object without flags
+        return isinstance(data.get('version'), int) and data.get('hardlinks') is True
+
+    def load(self, content):
+        try:
+            if content:
+                data = json.loads(decompress_manifest(content))
+                if isinstance(data.get('version'), int):
+                    self.remote_algorithm = data.get('algorithm', 'md5')
+                    self.hardlinks = data.get('hardlinks') is True
+                    self.hashes = data.get('files', {})
+                    self._shard_digests = data.get('shards', {})
+                    self._unloaded_shards = set(self._shard_digests)
+                else:
+                    # Version 1: bare {path: md5} object
+                    self.remote_algorithm = 'md5'
+                    self.hashes = data
         except Exception as e:
-            print(f"Warning: Failed to parse remote hash file: {e}")
+            log.warning(f"Warning: Failed to parse remote hash file: {e}")
             self.hashes = {}
 
+    @staticmethod
+    def shard_of(relative_path):
+        return relative_path.split('/', 1)[0] if '/' in relative_path else ''
+
+    def shard_path(self, shard):
+        # Directory names may not be valid file names everywhere, so hash them
+        shard_id = hashlib.sha1(shard.encode('utf-8')).hexdigest()[:16]
+        return f"{self.hash_file_path}.d/{shard_id}"
+
+    def _load_shard(self, shard):
+        # Workers look up hashes concurrently: the first one loads a shard and
+        # the others wait for it. The shard stays unloaded until its hashes are
+        # merged, so a checkpoint in between keeps it in the index
+        with self.lock:
+            if shard not in self._unloaded_shards:
+                return
+            loaded = self._loading.get(shard)
+            waiting = loaded is not None
+            if not waiting:
+                loaded = self._loading[shard] = threading.Event()
+        if waiting:
+            loaded.wait()
+            return
+        shard_hashes = {}
+        try:
+            content = self.shard_loader(self.shard_path(shard)) if self.shard_loader else None
+            if content is None:
+                log.warning(f"Warning: Hash file shard for '{shard or '/'}' is missing, its files will be uploaded again.")
+            else:
+                shard_hashes = json.loads(decompress_manifest(content))
+        except Exception as e:
+            log.warning(f"Warning: Failed to parse hash file shard for '{shard or '/'}': {e}")
+        finally:
+            with self.lock:
+                self.hashes.update(shard_hashes)
+                self._unloaded_shards.discard(shard)
+                del self._loading[shard]
+            loaded.set()
+
     def get_remote_hash(self, relative_path):
+        if self._unloaded_shards:
+            shard = self.shard_of(relative_path)
+            if shard in self._unloaded_shards:
+                self._load_shard(shard)
         return self.hashes.get(relative_path)
 
+    def remote_paths(self):
+        """All tracked paths, loading any shards not looked at yet."""
+        with self.lock:
+            shards = list(self._unloaded_shards)
+        for shard in shards:
+            self._load_shard(shard)
+        return set(self.hashes)
+
+    def remote_dirs(self):
+        """
+        Directories that hold tracked files, without loading any shards:
+        the index names the top-level directory of each.
+        """
+        with self.lock:
+            paths = list(self.hashes)
+        dirs = {shard for shard in self._shard_digests if shard}
+        for path in paths:
+            parent = posixpath.dirname(path)
+            while parent and parent not in dirs:
+                dirs.add(parent)
+                parent = posixpath.dirname(parent)
+        return dirs
+
+    def relocate(self, hash_file_path):
+        """
+        Move the hash file to a new remote path (a new release), loading every
+        shard first so the complete file is written there on the next save.
+        """
+        self.remote_paths()
+        self.hash_file_path = hash_file_path
+        self._shard_digests = {}
+
+    def paths_by_hash(self):
+        """Map each tracked hash to its paths, loading any shards not looked at yet."""
+        self.remote_paths()
+        index = {}
+        with self.lock:
+            for relative_path, file_hash in self.hashes.items():
+                index.setdefault(file_hash, []).append(relative_path)
+        return index
+
     def update_local_hash(self, relative_path, file_hash):
-        self.hashes[relative_path] = file_hash
+        with self.lock:
+            self.hashes[relative_path] = file_hash
+            self.dirty = True
+
+    def remove_hash(self, relative_path):
+        with self.lock:
+            self.hashes.pop(relative_path, None)
+            self.dirty = True
+
+    def set_hashes(self, hashes):
+        """Replace the tracked hashes with the current local state."""
+        with self.lock:
+            self.hashes = hashes
+            self._unloaded_shards = set()
+            self.dirty = True
+
+    def _header(self, version):
+        header = {'version': version, 'algorithm': self.algorithm}
+        if self.hardlinks:
+            header['hardlinks'] = True
+        return header
 
     def to_json(self):
-        return json.dumps(self.hashes, indent=2)
+        return _compact_json({**self._header(MANIFEST_VERSION), 'files': self.hashes})
+
+    def save(self, writer):
+        """
+        Write the hash file by calling writer(remote path, content) for each
+        file. Shards are written before the index that references them, and
+        shards never loaded in this run are kept as they are.
+        """
+        with self.lock:
+            self.dirty = False
+            if not self.sharded:
+                files = [(self.hash_file_path, self.to_json())]
+                digests = None
+            else:
+                shards = {}
+                for relative_path, file_hash in self.hashes.items():
+                    shards.setdefault(self.shard_of(relative_path), {})[relative_path] = file_hash
+
+                files = []
+                digests = {shard: self._shard_digests[shard] for shard in self._unloaded_shards}
+                for shard, entries in sorted(shards.items()):
+                    payload = _compact_json(entries)
+                    digests[shard] = hashlib.sha1(payload.encode('utf-8')).hexdigest()
+                    if self._shard_digests.get(shard) != digests[shard]:
+                        files.append((self.shard_path(shard), payload))
+
+                files.append((self.hash_file_path, _compact_json({**self._header(SHARDED_MANIFEST_VERSION), 'shards': digests})))
+
+        for remote_path, text in files:
+            writer(remote_path, compress_manifest(text, self.compression))
+        if digests is not None:
+            self._shard_digests = digests
+
+class StatCache:
+    """
+    Local cache of file hashes keyed by relative path and stat signature
+    (size, mtime_ns, inode), persisted between runs so unchanged files
+    don't have to be re-read.
+    """
+    def __init__(self, cache_path, algorithm='md5'):
+        self.cache_path = cache_path
+        self.algorithm = algorithm
+        self.entries = {}
+        self.updated = {}
 
-def compute_file_hash(filepath):
-    """Compute MD5 hash of a file."""
-    hash_md5 = hashlib.md5()
+    def load(self):
+        if not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, 'r') as f:
+                data = json.load(f)
+            # Hashes of another algorithm are useless, start over
+            if data.get('algorithm', 'md5') == self.algorithm:
+                self.entries = data.get('files', {})
+        except Exception as e:
+            log.warning(f"Warning: Failed to load hash cache: {e}")
+            self.entries = {}
+
+    @staticmethod
+    def signature(file_stat):
+        return [file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino]
+
+    def get_hash(self, relative_path, file_stat):
+        """Return the cached hash if the file's stat signature is unchanged."""
+        entry = self.entries.get(relative_path)
+        if entry and entry[:3] == self.signature(file_stat):
+            return entry[3]
+        return None
+
+    def update(self, relative_path, file_stat, file_hash):
+        self.updated[relative_path] = self.signature(file_stat) + [file_hash]
+
+    def save(self):
+        # Only files seen in this run are kept, so deleted files drop out
+        tmp_path = f"{self.cache_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': 1, 'algorithm': self.algorithm, 'files': self.updated}, f)
+        os.replace(tmp_path, self.cache_path)
+
+def parse_size(value):
+    """Parse a byte size such as '1048576', '512K', '64M' or '1G'."""
+    value = value.strip().upper().rstrip('B')
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+def is_compressible(filepath):
+    """Guess whether zlib would shrink a file, by extension or sampled entropy."""
+    if os.path.splitext(filepath)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+        return False
+    try:
+        with open(filepath, 'rb') as f:
+            sample = f.read(COMPRESSIBLE_SAMPLE_SIZE)
+    except OSError:
+        return True
+    if len(sample) < COMPRESSIBLE_SAMPLE_SIZE:
+        return True
+    entropy = -sum(count / len(sample) * math.log2(count / len(sample)) for count in collections.Counter(sample).values())
+    return entropy < INCOMPRESSIBLE_ENTROPY
+
+def new_hasher(algorithm):
+    """
+    Create a hash object for the given algorithm name.
+    blake3 and xxh3 need the optional blake3 / xxhash packages.
+    """
+    if algorithm == 'blake3':
+        import blake3
+        return blake3.blake3()
+    if algorithm == 'xxh3':
+        import xxhash
+        return xxhash.xxh3_128()
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError(f"Unsupported hash algorithm: {algorithm}. Supported: {', '.join(HASH_ALGORITHMS)}.")
+    return hashlib.new(algorithm)
+
+def compute_file_digests(filepath, algorithms=('md5',)):
+    """
+    Compute hashes of a file for several algorithms in a single read.
+    Large files are mmapped so the data is never copied into Python.
+    """
+    hashers = [new_hasher(a) for a in algorithms]
     try:
         with open(filepath, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
+            if os.fstat(f.fileno()).st_size >= HASH_MMAP_THRESHOLD:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    for hasher in hashers:
+                        hasher.update(mm)
+            else:
+                for chunk in iter(lambda: f.read(HASH_BUFFER_SIZE), b""):
+                    for hasher in hashers:
+                        hasher.update(chunk)
+        return tuple(hasher.hexdigest() for hasher in hashers)
     except FileNotFoundError:
         return None
 
-def scan_directory(local_dir, exclude_patterns=None):
+def compute_file_hash(filepath, algorithm='md5'):
+    """Compute the hash of a file (MD5 by default)."""
+    digests = compute_file_digests(filepath, (algorithm,))
+    return digests[0] if digests else None
+
+def compute_file_hashes(filepaths, algorithms=('md5',)):
     """
-    Scan directory and return list of relative paths.
+    Compute hashes for a batch of files, returning a (digests, error) pair per file.
+    Runs in a hashing process, so errors are returned rather than raised.
+    """
+    results = []
+    for filepath in filepaths:
+        try:
+            results.append((compute_file_digests(filepath, algorithms), None))
+        except Exception as e:
+            results.append((None, f"{e}"))
+    return results
+
+def iter_directory(local_dir, exclude_patterns=None):
+    """
+    Lazily walk a directory with os.scandir, yielding (relative path, stat)
+    for every file that isn't excluded. Like os.walk, symlinked directories
+    are not followed and unreadable sub-directories are skipped.
+
+    exclude_patterns is a list of patterns or an ExcludeMatcher.
     """
-    file_list = []
     local_dir = os.path.abspath(local_dir)
+    matcher = exclude_patterns if isinstance(exclude_patterns, ExcludeMatcher) else ExcludeMatcher(exclude_patterns or ())
     
     if not os.path.exists(local_dir):
         raise FileNotFoundError(f"Local directory not found: {local_dir}")
 
-    for root, dirs, files in os.walk(local_dir):
-        for file in files:
-            full_path = os.path.join(root, file)
-            rel_path = os.path.relpath(full_path, local_dir)
-            
+    stack = [(local_dir, '')]
+    while stack:
+        current_dir, rel_dir = stack.pop()
+        try:
+            with os.scandir(current_dir) as it:
+                entries = list(it)
+        except OSError:
+            if not rel_dir:
+                raise
+            continue
+
+        sub_dirs = []
+        for entry in entries:
             # Normalize path separators to forward slash for consistency
-            rel_path = rel_path.replace(os.sep, '/')
-            
-            if exclude_patterns:
-                # Check if matches any exclude pattern
-                matched = False
-                for pattern in exclude_patterns:
-                    if fnmatch.fnmatch(rel_path, pattern):
-                        matched = True
-                        break
-                if matched:
-                    continue
-            
-            file_list.append(rel_path)
-            
-    return file_list
+            rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                # Excluded directories are pruned here, never read
+                if not entry.is_symlink() and not (matcher and matcher.prunes(rel_path)):
+                    sub_dirs.append((entry.path, rel_path))
+                continue
+
+            if matcher and matcher.excluded(rel_path):
+                continue
+
+            try:
+                file_stat = entry.stat()
+            except OSError:
+                # Broken symlink; let the hashing stage report it
+                file_stat = None
+            yield rel_path, file_stat
+
+        # Reversed so directories are visited in listing order
+        stack.extend(reversed(sub_dirs))
+
+def scan_directory(local_dir, exclude_patterns=None):
+    """
+    Scan directory and return list of relative paths.
+    """
+    return [rel_path for rel_path, _ in iter_directory(local_dir, exclude_patterns)]